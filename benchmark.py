@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+# Drawing is measured too, so this needs a real display, just not a visible one
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+import game
+
+GRID_SIZE = game.GRID_SIZE
+WIDTHS = [32, 128, 512, 2048]
+HEIGHT = 10
+QUERIES = 1000
+
+# Synthetic levels: width in tiles, bees and coins scale with it
+LEVEL_SIZES = [{"width": 64, "bees": 8, "coins": 32},
+               {"width": 256, "bees": 32, "coins": 128},
+               {"width": 1024, "bees": 128, "coins": 512},
+               {"width": 4096, "bees": 512, "coins": 2048}]
+FRAMES = 300
+
+
+def make_blocks(width):
+    rng = random.Random(width)
+    blocks = []
+
+    for col in range(width):
+        blocks.append([col, HEIGHT - 1, "GM"])
+
+        if rng.random() < 0.3:
+            row = rng.randrange(2, HEIGHT - 1)
+            blocks.append([col, row, "GM"])
+
+    return blocks
+
+
+def make_probes(width):
+    rng = random.Random(-width)
+    img = pygame.Surface([GRID_SIZE, GRID_SIZE * 2])
+    probes = []
+
+    for i in range(QUERIES):
+        x = rng.randrange(0, width * GRID_SIZE)
+        y = rng.randrange(0, (HEIGHT - 1) * GRID_SIZE)
+        probes.append(game.Entity(x, y, img))
+
+    return probes
+
+
+def bench_collision(width):
+    blocks = make_blocks(width)
+    probes = make_probes(width)
+
+    img = pygame.Surface([GRID_SIZE, GRID_SIZE])
+    group = pygame.sprite.Group(game.Entity(col * GRID_SIZE, row * GRID_SIZE, img) for col, row, key in blocks)
+    index = game.TileMap(blocks, {"GM": img})
+
+    for p in probes:
+        expected = sorted(tuple(s.rect) for s in pygame.sprite.spritecollide(p, group, False))
+        assert expected == sorted(tuple(r) for r in index.collide(p))
+
+    def run_group():
+        for p in probes:
+            pygame.sprite.spritecollide(p, group, False)
+
+    def run_index():
+        for p in probes:
+            index.collide(p)
+
+    t_group = min(timeit.repeat(run_group, number=1, repeat=5))
+    t_index = min(timeit.repeat(run_index, number=1, repeat=5))
+
+    return len(blocks), t_group, t_index
+
+
+def make_level(size):
+    # Same schema as levels/*.json
+    width = size["width"]
+    rng = random.Random(width)
+    blocks = make_blocks(width)
+    solid = {(col, row) for col, row, key in blocks}
+
+    def free_cells(count):
+        cells = []
+
+        while len(cells) < count:
+            cell = [rng.randrange(8, width - 1), rng.randrange(1, HEIGHT - 1)]
+
+            if tuple(cell) not in solid:
+                cells.append(cell)
+
+        return cells
+
+    with open("levels/earth.json", 'r') as f:
+        map_data = json.load(f)
+
+    map_data.update({"name": "Bench {}".format(width),
+                     "width": width,
+                     "height": HEIGHT,
+                     "start": [1, 1],
+                     "blocks": blocks,
+                     "bees": free_cells(size["bees"]),
+                     "coins": free_cells(size["coins"]),
+                     "falseys": free_cells(size["coins"] // 16),
+                     "stars": free_cells(4),
+                     "oneups": free_cells(4),
+                     "hearts": free_cells(4),
+                     "signExit": [[width - 2, HEIGHT - 2]]})
+
+    return map_data
+
+
+def surface_bytes(level):
+    # tracemalloc can't see pixel data, so count the level's own surfaces separately
+    surfaces = [s for s in vars(level).values() if isinstance(s, pygame.Surface)]
+    surfaces += [layer.image for layer in getattr(level, 'layers', [])]
+
+    return sum(s.get_width() * s.get_height() * s.get_bytesize() for s in surfaces)
+
+
+def bench_level(g, path):
+    game.levels[:] = [path]
+
+    t_load = min(timeit.repeat(lambda: game.Level(path), number=1, repeat=3))
+
+    tracemalloc.start()
+    level = game.Level(path)
+    heap, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Run right, jumping now and then, like a player would
+    g.level_cache = game.LevelCache(game.level_cache_size)
+    g.reset()
+    g.stage = game.Game.PLAYING
+
+    t_update = 0
+    t_draw = 0
+
+    for i in range(FRAMES):
+        g.hero.move_right()
+
+        if i % 30 == 0:
+            g.hero.jump(g.level.tilemap)
+
+        start_time = time.perf_counter()
+        g.update()
+        t_update += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        g.draw()
+        t_draw += time.perf_counter() - start_time
+
+    return {"load_ms": t_load * 1000,
+            "update_ms": t_update / FRAMES * 1000,
+            "draw_ms": t_draw / FRAMES * 1000,
+            "heap_kb": heap / 1024,
+            "surface_kb": surface_bytes(level) / 1024}
+
+
+def run_collision():
+    print("Collision: {} queries per run".format(QUERIES))
+    print("{:>8} {:>8} {:>14} {:>14} {:>8}".format("columns", "blocks", "spritecollide", "TileMap", "speedup"))
+
+    results = []
+
+    for width in WIDTHS:
+        n, t_group, t_index = bench_collision(width)
+        print("{:>8} {:>8} {:>12.2f}ms {:>12.2f}ms {:>7.1f}x".format(width, n, t_group * 1000, t_index * 1000, t_group / t_index))
+        results.append({"columns": width, "blocks": n, "spritecollide_ms": t_group * 1000, "tilemap_ms": t_index * 1000})
+
+    return results
+
+
+def run_levels(baseline):
+    print()
+    print("Levels: {} frames per level, times are per frame".format(FRAMES))
+    print("{:>8} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10} {:>12}".format("columns", "bees", "coins", "load", "update",
+                                                                          "draw", "heap", "surfaces"))
+
+    g = game.Game()
+    saved_levels = list(game.levels)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in LEVEL_SIZES:
+            path = os.path.join(tmp, "bench_{}.json".format(size["width"]))
+
+            with open(path, 'w') as f:
+                json.dump(make_level(size), f)
+
+            result = dict(size, **bench_level(g, path))
+            results.append(result)
+
+            print("{:>8} {:>6} {:>6} {:>8.1f}ms {:>8.3f}ms {:>8.3f}ms {:>8.0f}kB {:>10.0f}kB".format(
+                size["width"], size["bees"], size["coins"], result["load_ms"], result["update_ms"], result["draw_ms"],
+                result["heap_kb"], result["surface_kb"]))
+
+            if baseline is not None:
+                print_comparison(result, baseline)
+
+    game.levels[:] = saved_levels
+
+    return results
+
+
+def print_comparison(result, baseline):
+    # Ratios against a previous --output file, above 1.0 means this build is slower or bigger
+    for old in baseline.get("levels", []):
+        if old["width"] == result["width"]:
+            keys = ["load_ms", "update_ms", "draw_ms", "heap_kb", "surface_kb"]
+            ratios = ["{}: {:.2f}x".format(key, result[key] / old[key]) for key in keys if old.get(key)]
+            print("{:>8} vs baseline  {}".format("", "  ".join(ratios)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collision and level benchmarks")
+    parser.add_argument("--output", metavar="FILE", help="write results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a previous --output file")
+    parser.add_argument("--collision-only", action="store_true", help="skip the synthetic level benchmarks")
+    args = parser.parse_args()
+
+    baseline = None
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+    results = {"collision": run_collision()}
+
+    if not args.collision_only:
+        results["levels"] = run_levels(baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
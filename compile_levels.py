@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import array
+import glob
+import json
+import os
+import struct
+import sys
+import time
+
+os.environ.setdefault("HEADLESS", "1")
+
+import game
+import navgraph
+
+
+def to_little_endian(values):
+    if sys.byteorder != 'little':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+
+    return values.tobytes()
+
+
+def compile_level(source_path):
+    with open(source_path, 'r') as f:
+        map_data = json.load(f)
+
+    tilemap = game.TileMap(map_data['blocks'], game.block_images)
+
+    meta = {key: value for key, value in map_data.items() if key != 'blocks' and key not in game.LEVEL_ENTITIES}
+    meta['palette'] = tilemap.keys[1:]
+    meta['tile-bounds'] = [tilemap.col0, tilemap.row0, tilemap.cols, tilemap.rows]
+    meta_bytes = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+
+    stat = os.stat(source_path)
+    parts = [game.LEVEL_HEADER.pack(game.LEVEL_MAGIC, game.LEVEL_VERSION, stat.st_size, stat.st_mtime_ns, len(meta_bytes)),
+             meta_bytes,
+             to_little_endian(tilemap.tiles)]
+
+    for key in game.LEVEL_ENTITIES:
+        cells = array.array('h', [v for item in map_data.get(key, []) for v in item[:2]])
+        parts.append(struct.pack("<I", len(cells) // 2))
+        parts.append(to_little_endian(cells))
+
+    compiled_path = os.path.splitext(source_path)[0] + game.LEVEL_EXT
+
+    with open(compiled_path, 'wb') as f:
+        f.write(b"".join(parts))
+
+    return compiled_path
+
+
+def main():
+    paths = sys.argv[1:] or sorted(glob.glob("levels/*.json"))
+
+    for path in paths:
+        start_time = time.perf_counter()
+        compiled_path = compile_level(path)
+        elapsed = time.perf_counter() - start_time
+
+        print("{} -> {} ({} -> {} bytes, {:.1f}ms)".format(path, compiled_path, os.path.getsize(path),
+                                                          os.path.getsize(compiled_path), elapsed * 1000))
+
+        # Reachability is worked out here once, not while playing
+        start_time = time.perf_counter()
+        graph = navgraph.compile_graph(path)
+        elapsed = time.perf_counter() - start_time
+
+        print("{} -> {} ({} nodes, {:.1f}ms)".format(path, navgraph.nav_path(path), len(graph.nodes), elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main()
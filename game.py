@@ -1,22 +1,49 @@
 #!/usr/bin/env python3
 
+import argparse
+import array
+import collections
+import concurrent.futures
 import json
+import os
 import pygame
+import struct
 import sys
+import time
 import xbox360_controller
 
-pygame.mixer.pre_init()
-pygame.init()
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Headless mode runs the simulation without a window, mixer, fonts or image files.
+# The environment variable is for tools that import this module; run as a script, only the flags count.
+HEADLESS = "--headless" in sys.argv or "--replay" in sys.argv or (__name__ != "__main__" and os.environ.get("HEADLESS") == "1")
+
+if not HEADLESS:
+    pygame.mixer.pre_init()
+    pygame.init()
 
 # Window settings
 TITLE = "Alien"
 WIDTH = 960
 HEIGHT = 640
 FPS = 60
+MAX_FPS = 120
+MAX_STEPS = 5
 GRID_SIZE = 64
+CHUNK_SIZE = WIDTH
+DIRTY_MAX_RECTS = 24  # past this many changed regions, or this much area, a full flip is cheaper
+DIRTY_MAX_AREA = WIDTH * HEIGHT // 4
+BATCH_MIN_ENEMIES = 200  # levels with this many bees use EnemyBatch when numpy is installed
 
 # Options
 sound_on = True
+dirty_rects = True
+level_cache_size = 4
+loaded_music = None
+show_profiler = False
 
 # KB+M
 LEFT = pygame.K_a
@@ -25,96 +52,307 @@ SPRINT = pygame.K_LSHIFT
 MUTE = pygame.K_m
 PAUSE = pygame.K_p
 JUMP = pygame.K_SPACE
+PROFILE = pygame.K_F3
+
+# Key names for headless scripts
+KEY_NAMES = {"left": LEFT,
+             "right": RIGHT,
+             "sprint": SPRINT,
+             "mute": MUTE,
+             "pause": PAUSE,
+             "jump": JUMP,
+             "restart": pygame.K_r}
 
 # Levels
 levels = ["levels/earth.json"]
 
+# Input recordings: header, metadata JSON, then per frame the update count, held keys and key presses
+REPLAY_MAGIC = b"AREC"
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct("<4sHI")
+REPLAY_FRAME = struct.Struct("<BBB")
+REPLAY_KEYS = [LEFT, RIGHT, SPRINT]
+REPLAY_QUIT = 0
+
+# Profiler
+PROFILE_FRAMES = 600
+PROFILE_PHASES = ["events", "update", "collide", "draw", "flip"]  # collide is the part of update spent in Character collisions
+PROFILE_PERCENTILES = [50, 95, 99]
+
+# Compiled levels: header, metadata JSON, tile ids, then a (col, row) table per entity type
+LEVEL_EXT = ".lvl"
+LEVEL_MAGIC = b"ALVL"
+LEVEL_VERSION = 1
+LEVEL_HEADER = struct.Struct("<4sHqqI")
+LEVEL_ENTITIES = ["bees", "coins", "falseys", "stars", "oneups", "hearts", "signExit"]
+
+# Texture atlas made by pack_atlas.py
+ATLAS_INDEX = "assets/atlas.json"
+
 # Colors
 TRANSPARENT = (0, 0, 0, 0)
 DARK_BLUE = (16, 86, 103)
 WHITE = (255, 255, 255)
+OVERLAY = (0, 0, 0, 160)
+GREEN = (64, 224, 96)
+YELLOW = (240, 208, 48)
+RED = (232, 64, 48)
 
 # Fonts
-FONT_SM = pygame.font.Font("fonts/kenpixel.ttf", 32)
-FONT_MD = pygame.font.Font("fonts/kenpixel.ttf", 64)
-FONT_LG = pygame.font.Font("fonts/kenpixel.ttf", 72)
+if HEADLESS:
+    FONT_XS = FONT_SM = FONT_MD = FONT_LG = None
+else:
+    FONT_XS = pygame.font.Font("fonts/kenpixel.ttf", 12)
+    FONT_SM = pygame.font.Font("fonts/kenpixel.ttf", 32)
+    FONT_MD = pygame.font.Font("fonts/kenpixel.ttf", 64)
+    FONT_LG = pygame.font.Font("fonts/kenpixel.ttf", 72)
+
+
+# Assets
+class Assets():
+
+    def __init__(self):
+        self.decoded = {}
+        self.images = {}
+        self.transforms = {}
+        self.sounds = {}
+        self.atlas = None
+        self.atlas_rects = None
+        self.atlas_converted = False
+
+    def load_atlas(self):
+        self.atlas_rects = {}
+
+        if HEADLESS or not os.path.exists(ATLAS_INDEX):
+            return
+
+        with open(ATLAS_INDEX, 'r') as f:
+            index = json.load(f)
+
+        self.atlas = pygame.image.load(index['image'])
+
+        for entry in index['images']:
+            # Images edited since the atlas was packed are loaded from their own files instead
+            if not os.path.exists(entry['path']):
+                continue
+
+            stat = os.stat(entry['path'])
+
+            if [stat.st_size, stat.st_mtime_ns] != entry.get('source'):
+                continue
+
+            key = (entry['path'], entry['width'], entry['height'])
+            self.atlas_rects[key] = pygame.Rect(entry['rect'])
+
+    def in_atlas(self, key):
+        if self.atlas_rects is None:
+            self.load_atlas()
+
+        return key in self.atlas_rects
+
+    def decode(self, file_path, width, height):
+        if HEADLESS:
+            return pygame.Surface([width, height])
+
+        img = pygame.image.load(file_path)
+        img = pygame.transform.scale(img, (width, height))
+
+        return img
+
+    def decode_all(self, manifest):
+        # Runs on the preloader thread, so it only reads the caches and returns what it decoded.
+        # preload() stores the result on the main thread, and converting waits for image().
+        decoded = {}
+
+        for item in manifest:
+            if isinstance(item, str) or item in self.images or item in self.decoded:
+                continue
+
+            if self.atlas_rects is not None and item in self.atlas_rects:
+                continue
+
+            decoded[item] = self.decode(*item)
+
+        return decoded
+
+    def preload(self, manifest, decoded):
+        # Main thread only, the mixer isn't safe to use from the worker either
+        for item in manifest:
+            if isinstance(item, str):
+                self.sound(item)
+            elif item in decoded and item not in self.images and item not in self.decoded and not self.in_atlas(item):
+                self.decoded[item] = decoded[item]
+
+    def image(self, file_path, width=GRID_SIZE, height=GRID_SIZE):
+        key = (file_path, width, height)
+
+        if key in self.images:
+            return self.images[key]
+
+        display_ready = not HEADLESS and pygame.display.get_surface() is not None
+
+        if self.in_atlas(key):
+            # Packed images share one surface, so drawing them reads from the same pixels
+            if display_ready and not self.atlas_converted:
+                self.atlas = self.atlas.convert_alpha()
+                self.atlas_converted = True
+
+            img = self.atlas.subsurface(self.atlas_rects[key])
+        else:
+            img = self.decoded.pop(key, None)
+
+            if img is None:
+                img = self.decode(*key)
+
+            if display_ready:
+                img = img.convert_alpha()
+
+        self.images[key] = img
+
+        return self.images[key]
+
+    def transform(self, img, flip_x=False, flip_y=False, size=None):
+        # Keyed by the source surface itself, so every entity sharing an image shares its copies
+        key = (img, bool(flip_x), bool(flip_y), size)
+
+        if key not in self.transforms:
+            result = img
+
+            if size is not None:
+                result = pygame.transform.scale(result, size)
+
+            if flip_x or flip_y:
+                result = pygame.transform.flip(result, flip_x, flip_y)
+
+            self.transforms[key] = result
+
+        return self.transforms[key]
+
+    def sound(self, file_path):
+        if HEADLESS:
+            return None
+
+        if file_path not in self.sounds:
+            self.sounds[file_path] = pygame.mixer.Sound(file_path)
+
+        return self.sounds[file_path]
+
+
+class ImageTable():
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def __getitem__(self, key):
+        return load_image(self.paths[key])
+
+
+assets = Assets()
 
 
 # Helper functions
 def load_image(file_path, width=GRID_SIZE, height=GRID_SIZE):
-    img = pygame.image.load(file_path)
-    img = pygame.transform.scale(img, (width, height))
-
-    return img
+    return assets.image(file_path, width, height)
 
 
 def load_char(file_path, width=GRID_SIZE, height=GRID_SIZE):
-    img = pygame.image.load(file_path)
-    img = pygame.transform.scale(img, (width, height * 2))
+    return load_image(file_path, width, height * 2)
 
-    return img
 
+def flip_image(img):
+    return assets.transform(img, flip_x=True)
 
-def play_sound(sound, loops=0, maxtime=0, fade_ms=0):
-    if sound_on:
+
+def load_alien_images():
+    return {"run": [load_char(path) for path in ALIEN_IMAGES['run']],
+            "jump": load_char(ALIEN_IMAGES['jump']),
+            "stand": load_char(ALIEN_IMAGES['stand']),
+            "hit": load_char(ALIEN_IMAGES['hit'])}
+
+
+def load_music(file_path):
+    global loaded_music
+
+    if not HEADLESS and file_path != loaded_music:
+        pygame.mixer.music.load(file_path)
+        loaded_music = file_path
+
+
+def play_sound(file_path, loops=0, maxtime=0, fade_ms=0):
+    sound = assets.sound(file_path)
+
+    if sound_on and sound is not None:
         sound.play(loops, maxtime, fade_ms)
 
 
 def play_music():
+    if HEADLESS:
+        return
+
     if sound_on:
         pygame.mixer.music.play(-1)
     else:
         pygame.mixer.music.stop()
 
 
-# Images
-alien_walk1 = load_char("assets/Players/128x256/Blue/alienBlue_walk1.png")
-alien_walk2 = load_char("assets/Players/128x256/Blue/alienBlue_walk2.png")
-alien_jump = load_char("assets/Players/128x256/Blue/alienBlue_jump.png")
-alien_stand = load_char("assets/Players/128x256/Blue/alienBlue_stand.png")
-alien_hit = load_char("assets/Players/128x256/Blue/alienBlue_hit.png")
-alien_images = {"run": [alien_walk1, alien_walk2],
-                "jump": alien_jump,
-                "stand": alien_stand,
-                "hit": alien_hit}
-
-block_images = {"GL": load_image("assets/Ground/Grass/grassLeft.png"),
-                "GM": load_image("assets/Ground/Grass/grassMid.png"),
-                "GCR": load_image("assets/Ground/Grass/grassCliff_right.png"),
-                "GR": load_image("assets/Ground/Grass/grassRight.png"),
-                "GCL": load_image("assets/Ground/Grass/grassCliff_left.png"),
-                "G": load_image("assets/Ground/Grass/grass.png"),
-                "GC": load_image("assets/Ground/Grass/grassCenter.png"),
-                "GHM": load_image("assets/Ground/Grass/grassHalf_mid.png"),
-                "GHR": load_image("assets/Ground/Grass/grassHalf_right.png"),
-                "GHL": load_image("assets/Ground/Grass/grassHalf_left.png")}
-
-coin_img = load_image("assets/Items/coinGold.png")
-heart_img = load_image("assets/HUD/hudHeart_full.png")
-heart_empty_img = load_image("assets/HUD/hudHeart_empty.png")
-ruby_img = load_image("assets/Items/gemRed.png")
-falsey_img = load_image("assets/Items/coinBronze.png")
-star_img = load_image("assets/Items/star.png")
-oneup_img = load_image("assets/Items/gemBlue.png")
-soundon_img = load_image("assets/soundon.png")
-soundoff_img = load_image("assets/soundoff.png")
-signExit = load_image("assets/Tiles/signExit.png")
-
-hudPlayer_blue = load_image("assets/HUD/hudPlayer_blue.png")
-hudX = load_image("assets/HUD/hudX.png")
-
-Bee_img1 = load_image("assets/Enemies/bee.png")
-Bee_img2 = load_image("assets/Enemies/bee_move.png")
-Bee_images = [Bee_img1, Bee_img2]
+def stop_music():
+    if not HEADLESS:
+        pygame.mixer.music.stop()
+
+
+# Images, loaded on first use
+ALIEN_IMAGES = {"run": ["assets/Players/128x256/Blue/alienBlue_walk1.png",
+                        "assets/Players/128x256/Blue/alienBlue_walk2.png"],
+                "jump": "assets/Players/128x256/Blue/alienBlue_jump.png",
+                "stand": "assets/Players/128x256/Blue/alienBlue_stand.png",
+                "hit": "assets/Players/128x256/Blue/alienBlue_hit.png"}
+
+block_images = ImageTable({"GL": "assets/Ground/Grass/grassLeft.png",
+                           "GM": "assets/Ground/Grass/grassMid.png",
+                           "GCR": "assets/Ground/Grass/grassCliff_right.png",
+                           "GR": "assets/Ground/Grass/grassRight.png",
+                           "GCL": "assets/Ground/Grass/grassCliff_left.png",
+                           "G": "assets/Ground/Grass/grass.png",
+                           "GC": "assets/Ground/Grass/grassCenter.png",
+                           "GHM": "assets/Ground/Grass/grassHalf_mid.png",
+                           "GHR": "assets/Ground/Grass/grassHalf_right.png",
+                           "GHL": "assets/Ground/Grass/grassHalf_left.png"})
+
+COIN_IMG = "assets/Items/coinGold.png"
+HEART_IMG = "assets/HUD/hudHeart_full.png"
+HEART_EMPTY_IMG = "assets/HUD/hudHeart_empty.png"
+RUBY_IMG = "assets/Items/gemRed.png"
+FALSEY_IMG = "assets/Items/coinBronze.png"
+STAR_IMG = "assets/Items/star.png"
+ONEUP_IMG = "assets/Items/gemBlue.png"
+SOUNDON_IMG = "assets/soundon.png"
+SOUNDOFF_IMG = "assets/soundoff.png"
+SIGN_EXIT_IMG = "assets/Tiles/signExit.png"
+
+HUD_PLAYER_IMG = "assets/HUD/hudPlayer_blue.png"
+HUD_X_IMG = "assets/HUD/hudX.png"
+HUD_DIGIT_IMG = "assets/HUD/hud{}.png"
+
+BEE_IMAGES = ["assets/Enemies/bee.png", "assets/Enemies/bee_move.png"]
+
+# Images each kind of level entity needs
+ENTITY_IMAGES = {"bees": BEE_IMAGES,
+                 "coins": [COIN_IMG],
+                 "falseys": [FALSEY_IMG],
+                 "stars": [STAR_IMG],
+                 "oneups": [ONEUP_IMG],
+                 "hearts": [HEART_IMG],
+                 "signExit": [SIGN_EXIT_IMG]}
 
 # Sounds
-JUMP_SOUND = pygame.mixer.Sound("assets/Sounds/jump.wav")
-COIN_SOUND = pygame.mixer.Sound("assets/Sounds/pickup_coin.wav")
-POWERUP_SOUND = pygame.mixer.Sound("assets/Sounds/powerup.wav")
-HURT_SOUND = pygame.mixer.Sound("assets/Sounds/hurt.wav")
-DIE_SOUND = pygame.mixer.Sound("assets/Sounds/death.wav")
-LEVELUP_SOUND = pygame.mixer.Sound("assets/Sounds/level_up.wav")
-GAMEOVER_SOUND = pygame.mixer.Sound("assets/Sounds/game_over.wav")
+JUMP_SOUND = "assets/Sounds/jump.wav"
+COIN_SOUND = "assets/Sounds/pickup_coin.wav"
+POWERUP_SOUND = "assets/Sounds/powerup.wav"
+HURT_SOUND = "assets/Sounds/hurt.wav"
+DIE_SOUND = "assets/Sounds/death.wav"
+LEVELUP_SOUND = "assets/Sounds/level_up.wav"
+GAMEOVER_SOUND = "assets/Sounds/game_over.wav"
+SOUNDS = [JUMP_SOUND, COIN_SOUND, POWERUP_SOUND, HURT_SOUND, DIE_SOUND, LEVELUP_SOUND, GAMEOVER_SOUND]
 
 
 class Entity(pygame.sprite.Sprite):
@@ -130,15 +368,142 @@ class Entity(pygame.sprite.Sprite):
         self.vy = 0
         self.vx = 0
 
+        self.prev_x = x
+        self.prev_y = y
+
+    def save_position(self):
+        self.prev_x = self.rect.x
+        self.prev_y = self.rect.y
+
+    def get_draw_rect(self, alpha):
+        if self.prev_x == self.rect.x and self.prev_y == self.rect.y:
+            return self.rect
+
+        x = self.prev_x + (self.rect.x - self.prev_x) * alpha
+        y = self.prev_y + (self.rect.y - self.prev_y) * alpha
+
+        return pygame.Rect(round(x), round(y), self.rect.width, self.rect.height)
+
     def apply_gravity(self, level):
         self.vy += level.gravity
         self.vy = min(self.vy, level.terminal_velocity)
 
 
-class Block(Entity):
+class TileMap():
 
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+    def __init__(self, blocks, images):
+        # Terrain is a flat array of tile ids, 0 meaning empty, instead of a sprite per block
+        self.keys = [None]
+        self.images = [None]
+
+        if len(blocks) > 0:
+            self.col0 = min(item[0] for item in blocks)
+            self.row0 = min(item[1] for item in blocks)
+            self.cols = max(item[0] for item in blocks) - self.col0 + 1
+            self.rows = max(item[1] for item in blocks) - self.row0 + 1
+        else:
+            self.col0, self.row0, self.cols, self.rows = 0, 0, 0, 0
+
+        self.tiles = array.array('H', bytes(2 * self.cols * self.rows))
+
+        for col, row, key in blocks:
+            if key not in self.keys:
+                self.keys.append(key)
+                self.images.append(images[key])
+
+            self.tiles[(row - self.row0) * self.cols + col - self.col0] = self.keys.index(key)
+
+    @classmethod
+    def from_array(cls, keys, images, bounds, tiles):
+        tilemap = cls([], images)
+        tilemap.keys = [None] + keys
+        tilemap.images = [None] + [images[key] for key in keys]
+        tilemap.col0, tilemap.row0, tilemap.cols, tilemap.rows = bounds
+        tilemap.tiles = tiles
+
+        return tilemap
+
+    def get_range(self, rect):
+        left = max(rect.left // GRID_SIZE - self.col0, 0)
+        right = min((rect.right - 1) // GRID_SIZE - self.col0, self.cols - 1)
+        top = max(rect.top // GRID_SIZE - self.row0, 0)
+        bottom = min((rect.bottom - 1) // GRID_SIZE - self.row0, self.rows - 1)
+
+        return left, right, top, bottom
+
+    def get_tiles(self, rect):
+        tile_list = []
+        left, right, top, bottom = self.get_range(rect)
+
+        for row in range(top, bottom + 1):
+            i = row * self.cols
+
+            for col in range(left, right + 1):
+                tile = self.tiles[i + col]
+
+                if tile:
+                    x = (col + self.col0) * GRID_SIZE
+                    y = (row + self.row0) * GRID_SIZE
+                    tile_list.append((x, y, self.images[tile]))
+
+        return tile_list
+
+    def query(self, rect):
+        hit_list = []
+        left, right, top, bottom = self.get_range(rect)
+
+        for row in range(top, bottom + 1):
+            i = row * self.cols
+
+            for col in range(left, right + 1):
+                if self.tiles[i + col]:
+                    x = (col + self.col0) * GRID_SIZE
+                    y = (row + self.row0) * GRID_SIZE
+                    hit_list.append(pygame.Rect(x, y, GRID_SIZE, GRID_SIZE))
+
+        return hit_list
+
+    def collide(self, sprite):
+        return self.query(sprite.rect)
+
+    def sweep_x(self, start, end, direction):
+        # First block column met between start and end, scanning columns in the direction of travel
+        if direction == 0:
+            return None
+
+        left, right, top, bottom = self.get_range(start.union(end))
+
+        if direction > 0:
+            cols = range(left, right + 1)
+        else:
+            cols = range(right, left - 1, -1)
+
+        for col in cols:
+            for row in range(top, bottom + 1):
+                if self.tiles[row * self.cols + col]:
+                    return col + self.col0
+
+        return None
+
+    def sweep_y(self, start, end, direction):
+        if direction == 0:
+            return None
+
+        left, right, top, bottom = self.get_range(start.union(end))
+
+        if direction > 0:
+            rows = range(top, bottom + 1)
+        else:
+            rows = range(bottom, top - 1, -1)
+
+        for row in rows:
+            i = row * self.cols
+
+            for col in range(left, right + 1):
+                if self.tiles[i + col]:
+                    return row + self.row0
+
+        return None
 
 
 class Character(Entity):
@@ -147,13 +512,13 @@ class Character(Entity):
         super().__init__(0, 0, images['stand'])
 
         self.image_idle_right = images['stand']
-        self.image_idle_left = pygame.transform.flip(self.image_idle_right, 1, 0)
+        self.image_idle_left = flip_image(self.image_idle_right)
         self.images_run_right = images['run']
-        self.images_run_left = [pygame.transform.flip(img, 1, 0) for img in self.images_run_right]
+        self.images_run_left = [flip_image(img) for img in self.images_run_right]
         self.image_jump_right = images['jump']
-        self.image_jump_left = pygame.transform.flip(self.image_jump_right, 1, 0)
+        self.image_jump_left = flip_image(self.image_jump_right)
         self.image_hit_right = images['hit']
-        self.image_hit_left = pygame.transform.flip(self.image_hit_right, 1, 0)
+        self.image_hit_left = flip_image(self.image_hit_right)
 
         self.running_images = self.images_run_right
         self.image_index = 0
@@ -188,7 +553,7 @@ class Character(Entity):
     def jump(self, blocks):
         self.rect.y += 1
 
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = blocks.collide(self)
 
         if len(hit_list) > 0:
             self.vy = -self.jump_power
@@ -206,63 +571,73 @@ class Character(Entity):
             self.hearts = 0
 
     def move_and_process_blocks(self, blocks):
-        self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
-
-        for block in hit_list:
-            if self.vx > 0:
-                self.rect.right = block.rect.left
-                self.vx = 0
-            elif self.vx < 0:
-                self.rect.left = block.rect.right
-                self.vx = 0
+        # Swept against every cell between here and the target, so no speed can skip through a block
+        end = self.rect.copy()
+        end.x += self.vx
+        col = blocks.sweep_x(self.rect, end, self.vx)
+
+        if col is None:
+            self.rect.x = end.x
+        elif self.vx > 0:
+            self.rect.right = col * GRID_SIZE
+            self.vx = 0
+        else:
+            self.rect.left = (col + 1) * GRID_SIZE
+            self.vx = 0
 
         self.on_ground = False
-        self.rect.y += self.vy + 1  # the +1 is hacky. not sure why it helps.
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
-
-        for block in hit_list:
-            if self.vy > 0:
-                self.rect.bottom = block.rect.top
-                self.vy = 0
-                self.on_ground = True
-            elif self.vy < 0:
-                self.rect.top = block.rect.bottom
-                self.vy = 0
+        end = self.rect.copy()
+        end.y += self.vy + 1  # the +1 is hacky. not sure why it helps.
+        row = blocks.sweep_y(self.rect, end, self.vy)
+
+        if row is None:
+            self.rect.y = end.y
+        elif self.vy > 0:
+            self.rect.bottom = row * GRID_SIZE
+            self.vy = 0
+            self.on_ground = True
+        else:
+            self.rect.top = (row + 1) * GRID_SIZE
+            self.vy = 0
 
-    def process_coins(self, coins):
-        hit_list = pygame.sprite.spritecollide(self, coins, True)
+    def process_pickups(self, level):
+        # One query for everything the hero can pick up or touch, handled by kind
+        hit_list = level.pickups.collide(self.rect)
 
         if self.coin_score < 0:
             self.coin_score = 0
 
-        for coin in hit_list:
-            play_sound(COIN_SOUND)
-            self.coin_score += coin.value
+        for kind, p in hit_list:
+            if kind == 'coin':
+                play_sound(COIN_SOUND)
+                self.coin_score += p.value
 
-    def process_falseys(self, falseys):
-        hit_list = pygame.sprite.spritecollide(self, falseys, True)
+            elif kind == 'falsey':
+                play_sound(COIN_SOUND)
+                self.score += p.value
+                self.coin_score += p.value
 
-        for falsey in hit_list:
-            play_sound(COIN_SOUND)
-            self.score += falsey.value
-            self.coin_score += falsey.value
+            elif kind == 'star':
+                time = int(10 * FPS)
+                self.invincibility = time
 
-    def process_stars(self, stars):
-        hit_list = pygame.sprite.spritecollide(self, stars, True)
+                play_sound(POWERUP_SOUND)
 
-        for star in hit_list:
-            time = int(10 * FPS)
-            self.invincibility = time
+            elif kind == 'powerup':
+                play_sound(POWERUP_SOUND)
+                p.apply(self)
 
-            play_sound(POWERUP_SOUND)
+            elif kind == 'flag' and not level.completed:
+                level.completed = True
+                play_sound(LEVELUP_SOUND)
 
-    def process_enemies(self, enemies):
-        hit_list = pygame.sprite.spritecollide(self, enemies, False)
+    def process_enemies(self, level):
+        hit_list = [e for e in level.get_enemies_near(self.rect) if self.rect.colliderect(e.rect)]
 
         if len(hit_list) > 0 and self.invincibility == 0:
             if self.vy > 0:
                 [e.kill() for e in hit_list]
+                level.touched_enemies.update(hit_list)
                 play_sound(COIN_SOUND)
                 self.score += 1  # temp value
                 self.vy = -self.jump_power
@@ -275,20 +650,6 @@ class Character(Entity):
             self.hearts -= 1
             self.invincibility = int(0.75 * FPS)
 
-    def process_powerups(self, powerups):
-        hit_list = pygame.sprite.spritecollide(self, powerups, True)
-
-        for p in hit_list:
-            play_sound(POWERUP_SOUND)
-            p.apply(self)
-
-    def check_flag(self, level):
-        hit_list = pygame.sprite.spritecollide(self, level.flag, False)
-
-        if len(hit_list) > 0:
-            level.completed = True
-            play_sound(LEVELUP_SOUND)
-
     def set_image(self):
         if self.on_ground:
             if self.vx != 0:
@@ -332,20 +693,25 @@ class Character(Entity):
         self.hearts = self.max_hearts
         self.invincibility = 0
         self.facing_right = True
+        self.save_position()
 
     def update(self, level):
-        self.process_enemies(level.enemies)
+        self.save_position()
+
+        with profiler.phase('collide'):
+            self.process_enemies(level)
+
         self.apply_gravity(level)
-        self.move_and_process_blocks(level.blocks)
+
+        with profiler.phase('collide'):
+            self.move_and_process_blocks(level.tilemap)
+
         self.check_world_boundaries(level)
         self.set_image()
 
         if self.hearts > 0:
-            self.process_coins(level.coins)
-            self.process_falseys(level.falseys)
-            self.process_stars(level.stars)
-            self.process_powerups(level.powerups)
-            self.check_flag(level)
+            with profiler.phase('collide'):
+                self.process_pickups(level)
 
             if self.invincibility > 0:
                 self.invincibility -= 1
@@ -353,30 +719,103 @@ class Character(Entity):
             self.die()
 
 
-class Coin(Entity):
+class Pickup():
+    # Pickups never move, so they skip the Sprite machinery and carry only a rect and an image
+    __slots__ = ['rect', 'image']
+
+    value = 0
+
     def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+        self.image = image
+        self.rect = pygame.Rect(x, y, image.get_width(), image.get_height())
 
-        self.value = 1
+    def get_draw_rect(self, alpha):
+        return self.rect
 
 
-class Ruby(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+class PickupIndex():
 
-        self.value = 10
+    def __init__(self):
+        # Every pickup with its kind, bucketed by CHUNK_SIZE columns as packed rect lists
+        self.buckets = {}
+        self.collected = []
+        self.margin = 0
 
+    def add(self, kind, pickup):
+        chunk = pickup.rect.x // CHUNK_SIZE
 
-class Falsey(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+        if chunk not in self.buckets:
+            self.buckets[chunk] = ([], [])
 
-        self.value = -5
+        rects, items = self.buckets[chunk]
+        rects.append(pickup.rect)
+        items.append((kind, pickup))
 
+        # Pickups are bucketed by their left edge, so queries look this far back
+        self.margin = max(self.margin, pickup.rect.width)
+
+    def reset(self):
+        # Only the pickups taken since the last reset go back
+        for kind, pickup in self.collected:
+            self.add(kind, pickup)
+
+        self.collected = []
+
+    def __iter__(self):
+        for rects, items in self.buckets.values():
+            yield from items
+
+    def get_buckets(self, rect):
+        first = (rect.left - self.margin) // CHUNK_SIZE
+        last = (rect.right - 1) // CHUNK_SIZE
+
+        return [self.buckets[chunk] for chunk in range(first, last + 1) if chunk in self.buckets]
+
+    def query(self, rect):
+        hit_list = []
+
+        for rects, items in self.get_buckets(rect):
+            hit_list += [items[i] for i in rect.collidelistall(rects)]
+
+        return hit_list
+
+    def collide(self, rect):
+        # Like spritecollide with dokill, what was hit is taken out, except the flag which stays
+        hit_list = []
+
+        for rects, items in self.get_buckets(rect):
+            hits = rect.collidelistall(rects)
+            hit_list += [items[i] for i in hits]
+
+            for i in reversed(hits):
+                if items[i][0] != 'flag':
+                    self.collected.append(items[i])
+                    del rects[i]
+                    del items[i]
+
+        return hit_list
+
+
+class Coin(Pickup):
+    __slots__ = []
+
+    value = 1
 
-class Star(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+
+class Ruby(Pickup):
+    __slots__ = []
+
+    value = 10
+
+
+class Falsey(Pickup):
+    __slots__ = []
+
+    value = -5
+
+
+class Star(Pickup):
+    __slots__ = []
 
 
 class Enemy(Entity):
@@ -384,7 +823,7 @@ class Enemy(Entity):
         super().__init__(x, y, images[0])
 
         self.images_left = images
-        self.images_right = [pygame.transform.flip(img, 1, 0) for img in images]
+        self.images_right = [flip_image(img) for img in images]
         self.current_images = self.images_left
         self.image_index = 0
         self.steps = 0
@@ -409,25 +848,25 @@ class Enemy(Entity):
 
     def move_and_process_blocks(self, blocks):
         self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = blocks.collide(self)
 
         for block in hit_list:
             if self.vx > 0:
-                self.rect.right = block.rect.left
+                self.rect.right = block.left
                 self.reverse()
             elif self.vx < 0:
-                self.rect.left = block.rect.right
+                self.rect.left = block.right
                 self.reverse()
 
         self.rect.y += self.vy  # the +1 is hacky. not sure why it helps.
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = blocks.collide(self)
 
         for block in hit_list:
             if self.vy > 0:
-                self.rect.bottom = block.rect.top
+                self.rect.bottom = block.top
                 self.vy = 0
             elif self.vy < 0:
-                self.rect.top = block.rect.bottom
+                self.rect.top = block.bottom
                 self.vy = 0
 
     def set_images(self):
@@ -442,8 +881,9 @@ class Enemy(Entity):
 
     def update(self, level, hero):
         if self.is_near(hero):
+            self.save_position()
             self.apply_gravity(level)
-            self.move_and_process_blocks(level.blocks)
+            self.move_and_process_blocks(level.tilemap)
             self.check_world_boundaries(level)
             self.set_images()
 
@@ -454,7 +894,9 @@ class Enemy(Entity):
         self.vy = self.start_vy
         self.current_images = self.images_left
         self.image = self.current_images[0]
+        self.image_index = 0
         self.steps = 0
+        self.save_position()
 
 
 class Bee(Enemy):
@@ -473,67 +915,395 @@ class Bee(Enemy):
         reverse = False
 
         self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = blocks.collide(self)
 
         for block in hit_list:
             if self.vx > 0:
-                self.rect.right = block.rect.left
+                self.rect.right = block.left
                 self.reverse()
             elif self.vx < 0:
-                self.rect.left = block.rect.right
+                self.rect.left = block.right
                 self.reverse()
 
         self.rect.y += self.vy + 1  # the +1 is hacky. not sure why it helps.
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = blocks.collide(self)
 
         reverse = True
 
         for block in hit_list:
             if self.vy >= 0:
-                self.rect.bottom = block.rect.top
+                self.rect.bottom = block.top
                 self.vy = 0
 
-                if self.vx > 0 and self.rect.right <= block.rect.right:
+                if self.vx > 0 and self.rect.right <= block.right:
                     reverse = False
 
-                elif self.vx < 0 and self.rect.left >= block.rect.left:
+                elif self.vx < 0 and self.rect.left >= block.left:
                     reverse = False
 
             elif self.vy < 0:
-                self.rect.top = block.rect.bottom
+                self.rect.top = block.bottom
                 self.vy = 0
 
         if reverse:
             self.reverse()
 
 
-class OneUp(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+def round_rect(values):
+    # Rounds the way pygame.Rect does when a float is assigned to it
+    return numpy.where(values >= 0, numpy.floor(values + 0.5), numpy.ceil(values - 0.5))
+
+
+class EnemyBatch():
+
+    def __init__(self, enemies, level):
+        # Same physics as Bee, but for every awake bee at once
+        self.enemies = list(enemies)
+        self.width, self.height = self.enemies[0].rect.size
+        self.num_images = len(self.enemies[0].images_left)
+
+        self.start_x = numpy.array([e.start_x for e in self.enemies], dtype=float)
+        self.start_y = numpy.array([e.start_y for e in self.enemies], dtype=float)
+        self.start_vx = numpy.array([e.start_vx for e in self.enemies])
+        self.start_vy = numpy.array([e.start_vy for e in self.enemies])
+        self.start_vy = self.start_vy.astype(numpy.result_type(self.start_vy, level.gravity, level.terminal_velocity))
+
+        tilemap = level.tilemap
+        self.tilemap = tilemap
+        self.tiles = numpy.frombuffer(tilemap.tiles, dtype=numpy.uint16).reshape(tilemap.rows, tilemap.cols)
+
+        n = len(self.enemies)
+
+        self.x = self.start_x.copy()
+        self.y = self.start_y.copy()
+        self.vx = self.start_vx.copy()
+        self.vy = self.start_vy.copy()
+        self.alive = numpy.ones(n, dtype=bool)
+
+        # Enemy.current_images, image_index, steps and which frame is showing
+        self.right = numpy.zeros(n, dtype=bool)
+        self.image_index = numpy.zeros(n, dtype=int)
+        self.steps = numpy.zeros(n, dtype=int)
+        self.shown = numpy.zeros(n, dtype=int)
+        self.shown_right = numpy.zeros(n, dtype=bool)
+
+        # Bees that have been stepped since the last reset
+        self.touched = numpy.zeros(n, dtype=bool)
+
+    @staticmethod
+    def can_batch(enemies):
+        if numpy is None or len(enemies) < BATCH_MIN_ENEMIES:
+            return False
+
+        first = enemies[0]
+
+        return all(type(e) is Bee and e.rect.size == first.rect.size and
+                   len(e.images_left) == len(first.images_left) for e in enemies) and \
+            first.rect.width <= GRID_SIZE and first.rect.height <= GRID_SIZE
+
+    def get_near(self, rect):
+        near = numpy.nonzero((self.x > rect.left - self.width) & (self.x < rect.right))[0]
+
+        return [self.enemies[i] for i in near if self.enemies[i].alive()]
+
+    def get_touched(self):
+        return [self.enemies[i] for i in numpy.nonzero(self.touched)[0]]
+
+    def reset(self):
+        t = numpy.nonzero(self.touched)[0]
+
+        self.x[t] = self.start_x[t]
+        self.y[t] = self.start_y[t]
+        self.vx[t] = self.start_vx[t]
+        self.vy[t] = self.start_vy[t]
+        self.alive[t] = True
+
+        self.right[t] = False
+        self.image_index[t] = 0
+        self.steps[t] = 0
+        self.shown[t] = 0
+        self.shown_right[t] = False
+
+        self.touched[t] = False
+
+    def is_solid(self, cols, rows):
+        tm = self.tilemap
+        c = cols - tm.col0
+        r = rows - tm.row0
+
+        inside = (c >= 0) & (c < tm.cols) & (r >= 0) & (r < tm.rows)
+        solid = numpy.zeros(len(cols), dtype=bool)
+        solid[inside] = self.tiles[r[inside], c[inside]] != 0
+
+        return solid
+
+    def get_hits(self, x, y):
+        # A bee overlaps at most 2x2 cells, listed in the same row-major order as TileMap.query
+        left = x.astype(int) // GRID_SIZE
+        right = (x.astype(int) + self.width - 1) // GRID_SIZE
+        top = y.astype(int) // GRID_SIZE
+        bottom = (y.astype(int) + self.height - 1) // GRID_SIZE
+
+        cells = [(left, top, True),
+                 (right, top, right != left),
+                 (left, bottom, bottom != top),
+                 (right, bottom, (right != left) & (bottom != top))]
+
+        return [(col, row, valid & self.is_solid(col, row)) for col, row, valid in cells]
+
+    def reverse(self, s, mask):
+        s['vx'][mask] *= -1
+        s['right'][mask] = s['vx'][mask] >= 0
+        s['shown'][mask] = s['image_index'][mask]
+        s['shown_right'][mask] = s['right'][mask]
+
+    def step(self, s, level):
+        x, vx = s['x'], s['vx']
+
+        # Entity.apply_gravity
+        s['vy'] = numpy.minimum(s['vy'] + level.gravity, level.terminal_velocity)
+        vy = s['vy']
+
+        # Bee.move_and_process_blocks, horizontal
+        x[:] = round_rect(x + vx)
+
+        for col, row, hit in self.get_hits(x, s['y']):
+            moving_right = hit & (vx > 0)
+            moving_left = hit & (vx < 0)
+
+            x[moving_right] = col[moving_right] * GRID_SIZE - self.width
+            self.reverse(s, moving_right)
+            x[moving_left] = (col[moving_left] + 1) * GRID_SIZE
+            self.reverse(s, moving_left)
+
+        # Bee.move_and_process_blocks, vertical and turn at ledges
+        y = s['y']
+        y[:] = round_rect(y + (vy + 1))
+        reverse = numpy.ones(len(x), dtype=bool)
+
+        for col, row, hit in self.get_hits(x, y):
+            falling = hit & (vy >= 0)
+            rising = hit & (vy < 0)
+
+            y[falling] = row[falling] * GRID_SIZE - self.height
+            vy[falling] = 0
+            reverse[falling & (vx > 0) & (x + self.width <= (col + 1) * GRID_SIZE)] = False
+            reverse[falling & (vx < 0) & (x >= col * GRID_SIZE)] = False
+
+            y[rising] = (row[rising] + 1) * GRID_SIZE
+            vy[rising] = 0
+
+        self.reverse(s, reverse)
+
+        # Enemy.check_world_boundaries
+        too_far_left = x < 0
+        x[too_far_left] = 0
+        self.reverse(s, too_far_left)
+
+        too_far_right = ~too_far_left & (x + self.width > level.width)
+        x[too_far_right] = level.width - self.width
+        self.reverse(s, too_far_right)
+
+        # Enemy.set_images
+        show = s['steps'] == 0
+        s['shown'][show] = s['image_index'][show]
+        s['shown_right'][show] = s['right'][show]
+        s['image_index'][show] = (s['image_index'][show] + 1) % self.num_images
+        s['steps'] = (s['steps'] + 1) % 20
+
+    def update(self, level, hero):
+        awake = numpy.nonzero(self.alive & (numpy.abs(self.x - hero.rect.x) < 2 * WIDTH))[0]
+
+        # Bees the hero killed drop out for good
+        for i in awake:
+            if not self.enemies[i].alive():
+                self.alive[i] = False
+
+        awake = awake[self.alive[awake]]
+
+        if len(awake) == 0:
+            return
+
+        self.touched[awake] = True
+
+        names = ['x', 'y', 'vx', 'vy', 'right', 'image_index', 'steps', 'shown', 'shown_right']
+        s = {name: getattr(self, name)[awake] for name in names}
+
+        self.step(s, level)
+
+        for name in names:
+            getattr(self, name)[awake] = s[name]
+
+        for j, i in enumerate(awake):
+            e = self.enemies[i]
+            e.save_position()
+            e.rect.x = int(s['x'][j])
+            e.rect.y = int(s['y'][j])
+            e.vx = s['vx'][j].item()
+            e.vy = s['vy'][j].item()
+
+            if s['shown_right'][j]:
+                e.image = e.images_right[s['shown'][j]]
+            else:
+                e.image = e.images_left[s['shown'][j]]
+
+
+class OneUp(Pickup):
+    __slots__ = []
+
+    value = 5
 
     def apply(self, character):
-        character.lives += 1
-        self.value = 5
+        character.lives = min(character.lives + 1, 9)  # Max lives is 9 because I said so
 
 
-class Heart(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+class Heart(Pickup):
+    __slots__ = []
 
     def apply(self, character):
         character.hearts += 1
         character.hearts = min(character.hearts, character.max_hearts)
 
 
-class Flag(Entity):
-    def __init__(self, x, y, image):
-        super().__init__(x, y, image)
+class Flag(Pickup):
+    __slots__ = []
+
+
+def read_compiled_level(file_path, source_path=None):
+    with open(file_path, 'rb') as f:
+        data = f.read()
+
+    magic, version, source_size, source_mtime, meta_size = LEVEL_HEADER.unpack_from(data)
+
+    if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+        raise ValueError("{} is not a compiled level".format(file_path))
+
+    # A compiled level is stale as soon as its JSON source changes
+    if source_path is not None and os.path.exists(source_path):
+        stat = os.stat(source_path)
+
+        if (stat.st_size, stat.st_mtime_ns) != (source_size, source_mtime):
+            raise ValueError("{} is out of date".format(file_path))
+
+    pos = LEVEL_HEADER.size
+    map_data = json.loads(data[pos:pos + meta_size].decode('utf-8'))
+    pos += meta_size
+
+    col0, row0, cols, rows = map_data['tile-bounds']
+    tiles = array.array('H', data[pos:pos + 2 * cols * rows])
+    pos += 2 * cols * rows
+
+    if sys.byteorder != 'little':
+        tiles.byteswap()
+
+    map_data['tiles'] = tiles
+
+    for key in LEVEL_ENTITIES:
+        count, = struct.unpack_from("<I", data, pos)
+        pos += 4
+
+        cells = array.array('h', data[pos:pos + 4 * count])
+        pos += 4 * count
+
+        if sys.byteorder != 'little':
+            cells.byteswap()
+
+        map_data[key] = list(zip(cells[0::2], cells[1::2]))
+
+    return map_data
+
+
+def read_level(file_path):
+    if file_path.endswith(LEVEL_EXT):
+        return read_compiled_level(file_path)
+
+    # Prefer an up to date compiled level next to the JSON file
+    compiled_path = os.path.splitext(file_path)[0] + LEVEL_EXT
+
+    if os.path.exists(compiled_path):
+        try:
+            return read_compiled_level(compiled_path, file_path)
+        except (ValueError, struct.error):
+            pass
+
+    with open(file_path, 'r') as f:
+        data = f.read()
+
+    return json.loads(data)
+
+
+def load_layer_image(map_data, layer):
+    if map_data[layer + '-img'] == "":
+        return None
+
+    img = pygame.image.load(map_data[layer + '-img'])
+
+    if map_data[layer + '-fill-y']:
+        h = img.get_height()
+        w = int(img.get_width() * HEIGHT / h)
+        img = pygame.transform.scale(img, (w, HEIGHT))
+
+    return img
+
+
+def level_manifest(map_data):
+    if 'palette' in map_data:
+        keys = map_data['palette']
+    else:
+        keys = {item[2] for item in map_data['blocks']}
+
+    paths = [block_images.paths[key] for key in keys]
+
+    for kind, images in ENTITY_IMAGES.items():
+        if len(map_data.get(kind, [])) > 0:
+            paths += images
+
+    return [(path, GRID_SIZE, GRID_SIZE) for path in paths] + SOUNDS
+
+
+def preload_level(file_path):
+    # Reading, parsing and decoding don't need the display, so this can run on a worker thread
+    map_data = read_level(file_path)
+
+    if not HEADLESS:
+        map_data['layer-images'] = {layer: load_layer_image(map_data, layer) for layer in ['background', 'scenery']}
+        map_data['decoded-images'] = assets.decode_all(level_manifest(map_data))
+
+    return map_data
+
+
+class ParallaxLayer():
+
+    def __init__(self, image, y, repeat, speed):
+        # Repeating images are tiled once into a strip one image wider than the window and slid
+        # along modulo the image width; other images are blitted in part straight from the image
+        self.y = y
+        self.repeat = repeat
+        self.speed = speed
+        self.image_width = image.get_width()
+
+        if repeat:
+            self.image = pygame.Surface([WIDTH + self.image_width, image.get_height()], pygame.SRCALPHA, 32)
+
+            for x in range(0, WIDTH + self.image_width, self.image_width):
+                self.image.blit(image, [x, 0], special_flags=pygame.BLEND_RGBA_MAX)
+        else:
+            self.image = image
+
+    def draw(self, surface, offset_x, offset_y):
+        # Blits truncate float positions, same as the old level-wide layers did
+        x = int(offset_x / self.speed)
+        y = int(offset_y) + self.y
+
+        if self.repeat:
+            surface.blit(self.image, [x % self.image_width - self.image_width, y])
+        else:
+            surface.blit(self.image, [0, y], pygame.Rect(-x, 0, WIDTH, self.image.get_height()))
 
 
 class Level():
 
-    def __init__(self, file_path):
-        self.starting_blocks = []
+    def __init__(self, file_path, map_data=None):
         self.starting_enemies = []
         self.starting_coins = []
         self.starting_falseys = []
@@ -541,21 +1311,18 @@ class Level():
         self.starting_powerups = []
         self.starting_flag = []
 
-        self.blocks = pygame.sprite.Group()
         self.enemies = pygame.sprite.Group()
-        self.coins = pygame.sprite.Group()
-        self.falseys = pygame.sprite.Group()
-        self.stars = pygame.sprite.Group()
-        self.powerups = pygame.sprite.Group()
-        self.flag = pygame.sprite.Group()
+        self.enemy_chunks = {}
+        self.enemy_batch = None
+        self.touched_enemies = set()
 
         self.active_sprites = pygame.sprite.Group()
-        self.inactive_sprites = pygame.sprite.Group()
 
-        with open(file_path, 'r') as f:
-            data = f.read()
+        if map_data is None:
+            map_data = preload_level(file_path)
 
-        map_data = json.loads(data)
+        if not HEADLESS:
+            assets.preload(level_manifest(map_data), map_data['decoded-images'])
 
         self.name = map_data['name']
 
@@ -565,130 +1332,412 @@ class Level():
         self.start_x = map_data['start'][0] * GRID_SIZE
         self.start_y = map_data['start'][1] * GRID_SIZE
 
-        for item in map_data['blocks']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            img = block_images[item[2]]
-            self.starting_blocks.append(Block(x, y, img))
+        if 'tiles' in map_data:
+            self.tilemap = TileMap.from_array(map_data['palette'], block_images, map_data['tile-bounds'], map_data['tiles'])
+        else:
+            self.tilemap = TileMap(map_data['blocks'], block_images)
+
+        bee_images = [load_image(path) for path in BEE_IMAGES]
 
         for item in map_data['bees']:
             x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_enemies.append(Bee(x, y, Bee_images))
+            self.starting_enemies.append(Bee(x, y, bee_images))
 
         for item in map_data['coins']:
             x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_coins.append(Coin(x, y, coin_img))
+            self.starting_coins.append(Coin(x, y, load_image(COIN_IMG)))
 
         for item in map_data['falseys']:
             x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_coins.append(Falsey(x, y, falsey_img))
+            self.starting_coins.append(Falsey(x, y, load_image(FALSEY_IMG)))
 
         for item in map_data['stars']:
             x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_stars.append(Star(x, y, star_img))
+            self.starting_stars.append(Star(x, y, load_image(STAR_IMG)))
 
         for item in map_data['oneups']:
             x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(OneUp(x, y, oneup_img))
+            self.starting_powerups.append(OneUp(x, y, load_image(ONEUP_IMG)))
 
         for item in map_data['hearts']:
             x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(Heart(x, y, heart_img))
+            self.starting_powerups.append(Heart(x, y, load_image(HEART_IMG)))
 
         for i, item in enumerate(map_data['signExit']):
             x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_flag.append(Flag(x, y, signExit))
+            self.starting_flag.append(Flag(x, y, load_image(SIGN_EXIT_IMG)))
 
-        self.background_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.scenery_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.inactive_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.active_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
+        self.music = map_data['music']
 
-        if map_data['background-color'] != "":
-            self.background_layer.fill(map_data['background-color'])
+        self.gravity = map_data['gravity']
+        self.terminal_velocity = map_data['terminal-velocity']
 
-        if map_data['background-img'] != "":
-            background_img = pygame.image.load(map_data['background-img']).convert_alpha()
+        self.completed = False
 
-            if map_data['background-fill-y']:
-                h = background_img.get_height()
-                w = int(background_img.get_width() * HEIGHT / h)
-                background_img = pygame.transform.scale(background_img, (w, HEIGHT))
+        self.enemies.add(self.starting_enemies)
+        self.active_sprites.add(self.enemies)
 
-            if "top" in map_data['background-position']:
-                start_y = 0
-            elif "bottom" in map_data['background-position']:
-                start_y = self.height - background_img.get_height()
+        self.pickups = PickupIndex()
 
-            if map_data['background-repeat-x']:
-                for x in range(0, self.width, background_img.get_width()):
-                    self.background_layer.blit(background_img, [x, start_y])
-            else:
-                self.background_layer.blit(background_img, [0, start_y])
+        for kind, pickups in [('coin', self.starting_coins),
+                              ('falsey', self.starting_falseys),
+                              ('star', self.starting_stars),
+                              ('powerup', self.starting_powerups),
+                              ('flag', self.starting_flag)]:
+            for p in pickups:
+                self.pickups.add(kind, p)
 
-        if map_data['scenery-img'] != "":
-            scenery_img = pygame.image.load(map_data['scenery-img']).convert_alpha()
+        # Overlapping enemies are drawn in level order, whichever chunks they were found in
+        for i, e in enumerate(self.starting_enemies):
+            e.order = i
 
-            if map_data['scenery-fill-y']:
-                h = scenery_img.get_height()
-                w = int(scenery_img.get_width() * HEIGHT / h)
-                scenery_img = pygame.transform.scale(scenery_img, (w, HEIGHT))
+        if EnemyBatch.can_batch(self.starting_enemies):
+            self.enemy_batch = EnemyBatch(self.starting_enemies, self)
+        else:
+            for e in self.starting_enemies:
+                self.add_to_chunk(e)
 
-            if "top" in map_data['scenery-position']:
-                start_y = 0
-            elif "bottom" in map_data['scenery-position']:
-                start_y = self.height - scenery_img.get_height()
+        if not HEADLESS:
+            self.make_layers(map_data)
 
-            if map_data['scenery-repeat-x']:
-                for x in range(0, self.width, scenery_img.get_width()):
-                    self.scenery_layer.blit(scenery_img, [x, start_y])
-            else:
-                self.scenery_layer.blit(scenery_img, [0, start_y])
+    def make_layers(self, map_data):
+        # The background color is filled each frame, so nothing here is as wide as the level
+        if map_data['background-color'] != "":
+            self.background_color = map_data['background-color']
+        else:
+            self.background_color = None
 
-        pygame.mixer.music.load(map_data['music'])
+        self.layers = []
 
-        self.gravity = map_data['gravity']
-        self.terminal_velocity = map_data['terminal-velocity']
+        for layer, speed in [('background', 3), ('scenery', 2)]:
+            if map_data[layer + '-img'] != "":
+                img = map_data['layer-images'][layer].convert_alpha()
 
-        self.completed = False
-
-        self.blocks.add(self.starting_blocks)
-        self.enemies.add(self.starting_enemies)
-        self.coins.add(self.starting_coins)
-        self.falseys.add(self.starting_falseys)
-        self.stars.add(self.starting_stars)
-        self.powerups.add(self.starting_powerups)
-        self.flag.add(self.starting_flag)
+                if "top" in map_data[layer + '-position']:
+                    start_y = 0
+                elif "bottom" in map_data[layer + '-position']:
+                    start_y = self.height - img.get_height()
 
-        self.active_sprites.add(self.coins, self.enemies, self.powerups)
-        self.inactive_sprites.add(self.blocks, self.flag)
+                self.layers.append(ParallaxLayer(img, start_y, map_data[layer + '-repeat-x'], speed))
 
         # with this speed up blitting on slower computers?
         for s in self.active_sprites:
             s.image.convert()
 
-        for s in self.inactive_sprites:
-            s.image.convert()
+        for kind, p in self.pickups:
+            p.image.convert()
 
-        self.inactive_sprites.draw(self.inactive_layer)
+    def reset(self):
+        # Only pickups that were taken and enemies that woke up or died need restoring
+        self.completed = False
 
-        # is converting layers helpful at all?
-        self.background_layer.convert()
-        self.scenery_layer.convert()
-        self.inactive_layer.convert()
-        self.active_layer.convert()
+        self.pickups.reset()
 
-    def reset(self):
-        self.enemies.add(self.starting_enemies)
-        self.coins.add(self.starting_coins)
-        self.falseys.add(self.starting_falseys)
-        self.stars.add(self.starting_stars)
-        self.powerups.add(self.starting_powerups)
+        if self.enemy_batch is not None:
+            self.touched_enemies.update(self.enemy_batch.get_touched())
+            self.enemy_batch.reset()
 
-        self.active_sprites.add(self.coins, self.enemies, self.powerups, self.stars, self.falseys)
+        for e in self.touched_enemies:
+            if not e.alive():
+                self.enemies.add(e)
+                self.active_sprites.add(e)
 
-        for e in self.enemies:
             e.reset()
 
+            if self.enemy_batch is None:
+                self.enemy_chunks[e.chunk].remove(e)
+                self.add_to_chunk(e)
+
+        self.touched_enemies = set()
+
+    def get_chunk(self, x):
+        return int(x // CHUNK_SIZE)
+
+    def add_to_chunk(self, enemy):
+        enemy.chunk = self.get_chunk(enemy.rect.x)
+
+        if enemy.chunk not in self.enemy_chunks:
+            self.enemy_chunks[enemy.chunk] = pygame.sprite.Group()
+
+        self.enemy_chunks[enemy.chunk].add(enemy)
+
+    def get_enemies_near(self, rect):
+        # Enemies that could overlap rect, assuming none is wider than a tile
+        if self.enemy_batch is not None:
+            return self.enemy_batch.get_near(rect)
+
+        near = []
+
+        for chunk in range(self.get_chunk(rect.left - GRID_SIZE), self.get_chunk(rect.right - 1) + 1):
+            if chunk in self.enemy_chunks:
+                near += self.enemy_chunks[chunk].sprites()
+
+        return near
+
+    def update_enemies(self, hero):
+        if self.enemy_batch is not None:
+            self.enemy_batch.update(self, hero)
+            return
+
+        # Only chunks that can hold an enemy within is_near range of the hero wake up
+        first = self.get_chunk(hero.rect.x - 2 * WIDTH)
+        last = self.get_chunk(hero.rect.x + 2 * WIDTH)
+
+        awake = []
+
+        for chunk in range(first, last + 1):
+            if chunk in self.enemy_chunks:
+                awake += self.enemy_chunks[chunk].sprites()
+
+        self.touched_enemies.update(awake)
+
+        for e in awake:
+            e.update(self, hero)
+
+            if self.get_chunk(e.rect.x) != e.chunk:
+                self.enemy_chunks[e.chunk].remove(e)
+                self.add_to_chunk(e)
+
+
+class HUD():
+
+    def __init__(self):
+        self.digit_images = [load_image(HUD_DIGIT_IMG.format(i)) for i in range(10)]
+        self.texts = {}
+        self.state = None
+        self.surface = pygame.Surface([WIDTH, 3 * GRID_SIZE], pygame.SRCALPHA, 32)
+
+    def get_state(self, hero, level_name):
+        return (hero.score, hero.coin_score, hero.lives, hero.hearts, hero.max_hearts, level_name, sound_on)
+
+    def render_text(self, key, text):
+        # Only re-render a line when its text changes
+        if key not in self.texts or self.texts[key][0] != text:
+            self.texts[key] = (text, FONT_SM.render(text, 1, DARK_BLUE))
+
+        return self.texts[key][1]
+
+    def get_surface(self, hero, level_name):
+        state = self.get_state(hero, level_name)
+
+        if state != self.state:
+            self.state = state
+            self.compose(hero, level_name)
+
+        return self.surface
+
+    def compose(self, hero, level_name):
+        surface = self.surface
+        surface.fill(TRANSPARENT)
+
+        score_text = self.render_text('score', "Score: " + str(hero.score))
+        coin_score_text = self.render_text('coins', "Coins: " + str(hero.coin_score))
+        lvl_name = self.render_text('level', level_name)
+
+        # Music status icon
+        if sound_on:
+            surface.blit(load_image(SOUNDON_IMG), (32, 128))
+        else:
+            surface.blit(load_image(SOUNDOFF_IMG), (32, 128))
+
+        surface.blit(score_text, (WIDTH - score_text.get_width() - 32, 32))
+        surface.blit(coin_score_text, (WIDTH - score_text.get_width() - 32, 64))
+        surface.blit(lvl_name, (WIDTH - lvl_name.get_width() - 32, 96))
+
+        # Lives counter
+        surface.blit(load_image(HUD_PLAYER_IMG), (32, 64))
+        surface.blit(load_image(HUD_X_IMG), (32 * 3, 64))
+        if 0 <= hero.lives <= 9:
+            surface.blit(self.digit_images[hero.lives], (32 * 5, 64))
+
+        # Heart counter
+        spacing = 32
+        curr_max = hero.max_hearts * 2
+        multi = [i for i in range(1, curr_max, 2)]
+        for i in multi:
+            surface.blit(load_image(HEART_EMPTY_IMG), (spacing * i, 0))
+        for i in multi[:hero.hearts]:
+            surface.blit(load_image(HEART_IMG), (spacing * i, 0))
+
+
+class LevelPreloader():
+
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = {}
+
+    def preload(self, file_path):
+        if file_path not in self.pending:
+            self.pending[file_path] = self.executor.submit(preload_level, file_path)
+
+    def take(self, file_path):
+        future = self.pending.pop(file_path, None)
+
+        if future is None:
+            return None
+
+        try:
+            return future.result()
+        except Exception:
+            return None  # load it on the main thread instead
+
+
+class LevelCache():
+
+    def __init__(self, size):
+        self.size = size
+        self.levels = collections.OrderedDict()
+        self.preloader = LevelPreloader()
+
+    def preload(self, file_path):
+        if file_path not in self.levels:
+            self.preloader.preload(file_path)
+
+    def get(self, file_path):
+        # Built levels are kept and restored with Level.reset() instead of being loaded again
+        if file_path in self.levels:
+            self.levels.move_to_end(file_path)
+        else:
+            # Only surface conversion and layer building are left for the main thread
+            self.levels[file_path] = Level(file_path, self.preloader.take(file_path))
+
+            if len(self.levels) > self.size:
+                self.levels.popitem(last=False)
+
+        return self.levels[file_path]
+
+
+def merge_rects(rects):
+    # Overlapping rects are joined so no region is redrawn or pushed twice
+    merged = []
+
+    for rect in rects:
+        rect = rect.copy()
+        i = rect.collidelist(merged)
+
+        while i != -1:
+            rect.union_ip(merged.pop(i))
+            i = rect.collidelist(merged)
+
+        merged.append(rect)
+
+    return merged
+
+
+class ProfilePhase():
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+
+
+class FrameProfiler():
+
+    def __init__(self, size):
+        # One ring buffer of seconds per phase, plus the whole frame
+        self.size = size
+        self.names = PROFILE_PHASES + ['frame']
+        self.samples = {name: array.array('d', bytes(8 * size)) for name in self.names}
+        self.current = dict.fromkeys(PROFILE_PHASES, 0.0)
+        self.count = 0
+        self.frame_start = time.perf_counter()
+
+    def phase(self, name):
+        return ProfilePhase(self, name)
+
+    def add(self, name, seconds):
+        self.current[name] += seconds
+
+    def end_frame(self):
+        now = time.perf_counter()
+        i = self.count % self.size
+
+        for name in PROFILE_PHASES:
+            self.samples[name][i] = self.current[name]
+            self.current[name] = 0.0
+
+        self.samples['frame'][i] = now - self.frame_start
+        self.frame_start = now
+        self.count += 1
+
+    def get_samples(self, name):
+        # Oldest first
+        samples = self.samples[name]
+
+        if self.count <= self.size:
+            return samples[:self.count].tolist()
+
+        i = self.count % self.size
+        return (samples[i:] + samples[:i]).tolist()
+
+    def get_percentiles(self, name):
+        samples = sorted(self.get_samples(name))
+
+        if len(samples) == 0:
+            return [0.0 for p in PROFILE_PERCENTILES]
+
+        return [samples[(len(samples) - 1) * p // 100] for p in PROFILE_PERCENTILES]
+
+    def draw(self, surface):
+        width, height = 360, 200
+        panel = pygame.Surface([width, height], pygame.SRCALPHA, 32)
+        panel.fill(OVERLAY)
+
+        # Frame time graph, one column per frame, with a line at the frame budget
+        graph_height = 80
+        budget = 1 / FPS
+        frames = self.get_samples('frame')[-width:]
+
+        for x, t in enumerate(frames):
+            if t <= budget:
+                color = GREEN
+            elif t <= 2 * budget:
+                color = YELLOW
+            else:
+                color = RED
+
+            h = min(int(t / (2 * budget) * graph_height), graph_height)
+            pygame.draw.line(panel, color, (x, graph_height), (x, graph_height - h))
+
+        pygame.draw.line(panel, WHITE, (0, graph_height // 2), (width, graph_height // 2))
+
+        y = graph_height + 8
+        header = "{:<8}".format("ms") + "".join("{:>8}".format("p" + str(p)) for p in PROFILE_PERCENTILES)
+        panel.blit(FONT_XS.render(header, 1, WHITE), (8, y))
+
+        for name in self.names:
+            y += 16
+            line = "{:<8}".format(name) + "".join("{:>8.2f}".format(t * 1000) for t in self.get_percentiles(name))
+            panel.blit(FONT_XS.render(line, 1, WHITE), (8, y))
+
+        surface.blit(panel, (WIDTH - width - 16, HEIGHT - height - 16))
+
+    def export(self, file_path):
+        columns = [self.get_samples(name) for name in self.names]
+        rows = [[round(t * 1000, 4) for t in row] for row in zip(*columns)]
+
+        if file_path.endswith('.json'):
+            percentiles = {name: dict(zip(PROFILE_PERCENTILES, [round(t * 1000, 4) for t in self.get_percentiles(name)]))
+                           for name in self.names}
+
+            with open(file_path, 'w') as f:
+                json.dump({'columns': self.names, 'percentiles': percentiles, 'frames': rows}, f)
+        else:
+            with open(file_path, 'w') as f:
+                f.write(",".join(self.names) + "\n")
+
+                for row in rows:
+                    f.write(",".join(str(t) for t in row) + "\n")
+
+
+profiler = FrameProfiler(PROFILE_FRAMES)
+
 
 class Game():
 
@@ -705,6 +1754,11 @@ class Game():
         pygame.display.set_caption(TITLE)
         self.clock = pygame.time.Clock()
         self.done = False
+        self.last_frame = None
+        self.last_drawn = {}
+        self.recorder = None
+        self.hud = HUD()
+        self.level_cache = LevelCache(level_cache_size)
         # Controller
         try:
             self.gamepad = xbox360_controller.Controller(0)
@@ -714,9 +1768,14 @@ class Game():
         self.reset()
 
     def start(self):
-        self.level = Level(levels[self.current_level])
+        self.level = self.level_cache.get(levels[self.current_level])
         self.level.reset()
         self.hero.respawn(self.level)
+        load_music(self.level.music)
+
+        # Get the next level ready while this one is played
+        if self.current_level < len(levels) - 1:
+            self.level_cache.preload(levels[self.current_level + 1])
 
     def advance(self):
         self.current_level += 1
@@ -724,7 +1783,7 @@ class Game():
         self.stage = Game.START
 
     def reset(self):
-        self.hero = Character(alien_images)
+        self.hero = Character(load_alien_images())
         self.current_level = 0
         self.start()
         self.stage = Game.SPLASH
@@ -757,45 +1816,26 @@ class Game():
         surface.blit(line2, (x2, y2))
 
     def display_stats(self, surface):
-        global sound_on
-
-        score_text = FONT_SM.render("Score: " + str(self.hero.score), 1, DARK_BLUE)
-        coin_score_text = FONT_SM.render("Coins: " + str(self.hero.coin_score), 1, DARK_BLUE)
-        lvl_name = FONT_SM.render(self.level.name, 1, DARK_BLUE)
-
-        # Music status icon
-        if sound_on:
-            surface.blit(soundon_img, (32, 128))
-        else:
-            surface.blit(soundoff_img, (32, 128))
-
-        surface.blit(score_text, (WIDTH - score_text.get_width() - 32, 32))
-        surface.blit(coin_score_text, (WIDTH - score_text.get_width() - 32, 64))
-        surface.blit(lvl_name, (WIDTH - lvl_name.get_width() - 32, 96))
+        surface.blit(self.hud.get_surface(self.hero, self.level.name), (0, 0))
 
-        # Lives counter
-        surface.blit(hudPlayer_blue, (32, 64))
-        surface.blit(hudX, (32 * 3, 64))
-        if self.hero.lives <= 9:
-            hudnum = load_image("assets/HUD/hud{}.png".format(self.hero.lives))
-            surface.blit(hudnum, (32 * 5, 64))
-        else:
-            self.hero.lives = 9  # Max lives is 9 because I said so
+    def process_events(self):
+        events = pygame.event.get()
+        pressed = pygame.key.get_pressed()
+        self.handle_input(events, pressed)
 
-        # Heart counter
-        spacing = 32
-        curr_max = self.hero.max_hearts * 2
-        multi = [i for i in range(1, curr_max, 2)]
-        for i in multi:
-            surface.blit(heart_empty_img, (spacing * i, 0))
-        for i in multi[:self.hero.hearts]:
-            surface.blit(heart_img, (spacing * i, 0))
+        return events, pressed
 
-    def process_events(self):
-        global sound_on
-        for event in pygame.event.get():
+    def handle_input(self, events, pressed):
+        global sound_on, show_profiler
+        for event in events:
             if event.type == pygame.QUIT:
                 self.done = True
+            if event.type in [pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED]:
+                # The window lost its contents, so the next draw repaints all of it
+                self.last_frame = None
+            if event.type == pygame.KEYDOWN and event.key == PROFILE:
+                show_profiler = not show_profiler
+                continue
             if self.gamepad:
                 if event.type == pygame.JOYBUTTONDOWN:
                     if self.stage == Game.SPLASH or self.stage == Game.START:
@@ -804,7 +1844,7 @@ class Game():
 
                     elif self.stage == Game.PLAYING:
                         if event.button == xbox360_controller.A:
-                            self.hero.jump(self.level.blocks)
+                            self.hero.jump(self.level.tilemap)
                         elif event.button == xbox360_controller.START:
                             self.stage = Game.PAUSED
 
@@ -825,7 +1865,7 @@ class Game():
 
                 elif self.stage == Game.PLAYING:
                     if event.key == JUMP:
-                        self.hero.jump(self.level.blocks)
+                        self.hero.jump(self.level.tilemap)
                     if event.key == MUTE:
                         if sound_on:
                             sound_on = False
@@ -864,7 +1904,6 @@ class Game():
                     self.hero.speed = 5
 
         elif self.gamepad is None:
-            pressed = pygame.key.get_pressed()
             if self.stage == Game.PLAYING:
                 if pressed[LEFT]:
                     self.hero.move_left()
@@ -880,48 +1919,64 @@ class Game():
     def update(self):
         if self.stage == Game.PLAYING:
             self.hero.update(self.level)
-            self.level.enemies.update(self.level, self.hero)
+            self.level.update_enemies(self.hero)
 
         if self.level.completed:
             if self.current_level < len(levels) - 1:
                 self.stage = Game.LEVEL_COMPLETED
             else:
                 self.stage = Game.VICTORY
-            pygame.mixer.music.stop()
+            stop_music()
 
         elif self.hero.lives == 0:
             self.stage = Game.GAME_OVER
-            pygame.mixer.music.stop()
+            stop_music()
 
         elif self.hero.hearts == 0:
             self.level.reset()
             self.hero.respawn(self.level)
 
-    def calculate_offset(self):
-        x = -1 * self.hero.rect.centerx + WIDTH / 2
+    def calculate_offset(self, alpha=1):
+        centerx = self.hero.get_draw_rect(alpha).centerx
+        x = -1 * centerx + WIDTH / 2
 
-        if self.hero.rect.centerx < WIDTH / 2:
+        if centerx < WIDTH / 2:
             x = 0
-        elif self.hero.rect.centerx > self.level.width - WIDTH / 2:
+        elif centerx > self.level.width - WIDTH / 2:
             x = -1 * self.level.width + WIDTH
 
         return x, 0
 
-    def draw(self):
-        offset_x, offset_y = self.calculate_offset()
-
-        self.level.active_layer.fill(TRANSPARENT)
-        self.level.active_sprites.draw(self.level.active_layer)
+    def get_visible(self, camera):
+        visible = [p for kind, p in self.level.pickups.query(camera)]
+        enemies = [e for e in self.level.get_enemies_near(camera) if camera.colliderect(e.rect)]
+        visible += sorted(enemies, key=lambda e: e.order)
 
         if self.hero.invincibility % 3 < 2:
-            self.level.active_layer.blit(self.hero.image, [self.hero.rect.x, self.hero.rect.y])
+            visible.append(self.hero)
+
+        return visible
 
-        self.window.blit(self.level.background_layer, [offset_x / 3, offset_y])
-        self.window.blit(self.level.scenery_layer, [offset_x / 2, offset_y])
-        self.window.blit(self.level.inactive_layer, [offset_x, offset_y])
-        self.window.blit(self.level.active_layer, [offset_x, offset_y])
+    def hud_state(self):
+        return self.hud.get_state(self.hero, self.level.name)
 
-        self.display_stats(self.window)
+    def draw_scene(self, offset_x, offset_y, items, rects, area=None):
+        # With an area, the window is clipped to it and only items overlapping it are blitted
+        if self.level.background_color is not None:
+            self.window.fill(self.level.background_color)
+
+        for layer in self.level.layers:
+            layer.draw(self.window, offset_x, offset_y)
+
+        if area is None:
+            for image, rect in items:
+                self.window.blit(image, rect)
+        else:
+            for i in area.collidelistall(rects):
+                self.window.blit(*items[i])
+
+        if area is None or area.colliderect(self.hud.surface.get_rect()):
+            self.display_stats(self.window)
 
         if self.stage == Game.SPLASH:
             self.display_splash(self.window)
@@ -936,19 +1991,291 @@ class Game():
         elif self.stage == Game.GAME_OVER:
             self.display_message(self.window, "Game Over", "Press 'R' to restart.")
 
-        pygame.display.flip()
+    def draw(self, alpha=1):
+        # Blend between the last two simulation steps, but only while things move
+        if self.stage != Game.PLAYING:
+            alpha = 1
+
+        offset_x, offset_y = self.calculate_offset(alpha)
+
+        # Only tiles and sprites inside the camera get drawn. The margin covers
+        # sprites whose interpolated position is on screen but whose rect isn't yet.
+        camera = pygame.Rect(-offset_x, -offset_y, WIDTH, HEIGHT)
+        visible = self.get_visible(camera.inflate(2 * GRID_SIZE, 2 * GRID_SIZE))
+
+        frame = (offset_x, offset_y, self.stage, self.hud_state())
+        drawn = {}
+
+        for x, y, image in self.level.tilemap.get_tiles(camera):
+            drawn[x, y] = (image, pygame.Rect(x + offset_x, y + offset_y, GRID_SIZE, GRID_SIZE))
+
+        for s in visible:
+            drawn[s] = (s.image, s.get_draw_rect(alpha).move(offset_x, offset_y))
+
+        items = list(drawn.values())
+        rects = [rect for image, rect in items]
+        dirty = None
+
+        if dirty_rects and frame == self.last_frame and not show_profiler:
+            # Same camera and HUD, so only where sprites moved, changed or disappeared needs redrawing
+            changed = [rect for s, (image, rect) in drawn.items() if self.last_drawn.get(s) != (image, rect)]
+            changed += [rect for s, (image, rect) in self.last_drawn.items() if drawn.get(s) != (image, rect)]
+            dirty = merge_rects(changed)
+
+            if len(dirty) > DIRTY_MAX_RECTS or sum(r.width * r.height for r in dirty) > DIRTY_MAX_AREA:
+                dirty = None
+
+        if dirty is None:
+            self.draw_scene(offset_x, offset_y, items, rects)
+
+            if show_profiler:
+                profiler.draw(self.window)
+
+            with profiler.phase('flip'):
+                pygame.display.flip()
+        else:
+            for rect in dirty:
+                self.window.set_clip(rect)
+                self.draw_scene(offset_x, offset_y, items, rects, rect)
+
+            self.window.set_clip(None)
+
+            if len(dirty) > 0:
+                with profiler.phase('flip'):
+                    pygame.display.update(dirty)
+
+        self.last_frame = frame
+        self.last_drawn = drawn
 
     def loop(self):
+        # Simulate in fixed steps of 1 / FPS no matter how fast frames are drawn
+        step = 1 / FPS
+        lag = 0
+        previous = time.perf_counter()
+
         while not self.done:
-            self.process_events()
-            self.update()
-            self.draw()
-            self.clock.tick(FPS)
+            now = time.perf_counter()
+            lag += now - previous
+            previous = now
+
+            with profiler.phase('events'):
+                events, pressed = self.process_events()
+
+            steps = 0
+            while lag >= step and steps < MAX_STEPS:
+                with profiler.phase('update'):
+                    self.update()
+
+                lag -= step
+                steps += 1
+
+            if self.recorder is not None:
+                self.recorder.record(events, pressed, steps)
+
+            # Too far behind to catch up, so drop the time instead of spiraling
+            if lag >= step:
+                lag %= step
+
+            # draw includes flip here, end_frame takes it back out
+            with profiler.phase('draw'):
+                self.draw(lag / step)
+
+            profiler.current['draw'] -= profiler.current['flip']
+            profiler.end_frame()
+
+            self.clock.tick(MAX_FPS)
+
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+class InputRecorder():
+
+    def __init__(self, file_path):
+        self.file = open(file_path, 'wb')
+
+        meta = json.dumps({'levels': levels, 'fps': FPS}).encode('utf-8')
+        self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, len(meta)))
+        self.file.write(meta)
+
+    def record(self, events, pressed, steps):
+        # Only what handle_input reads from the keyboard is kept
+        held = 0
+
+        for i, key in enumerate(REPLAY_KEYS):
+            if pressed[key]:
+                held |= 1 << i
+
+        presses = []
+
+        for event in events:
+            if event.type == pygame.QUIT:
+                presses.append(REPLAY_QUIT)
+            elif event.type == pygame.KEYDOWN:
+                presses.append(event.key)
+
+        self.file.write(REPLAY_FRAME.pack(steps, held, len(presses)))
+        self.file.write(struct.pack("<{}I".format(len(presses)), *presses))
+
+    def close(self):
+        self.file.close()
+
+
+def read_replay(file_path):
+    with open(file_path, 'rb') as f:
+        data = f.read()
+
+    magic, version, meta_size = REPLAY_HEADER.unpack_from(data)
+
+    if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+        raise ValueError("{} is not an input recording".format(file_path))
+
+    pos = REPLAY_HEADER.size
+    meta = json.loads(data[pos:pos + meta_size].decode('utf-8'))
+    pos += meta_size
+
+    frames = []
+
+    while pos < len(data):
+        steps, held, count = REPLAY_FRAME.unpack_from(data, pos)
+        pos += REPLAY_FRAME.size
+
+        presses = struct.unpack_from("<{}I".format(count), data, pos)
+        pos += 4 * count
+
+        held_keys = [key for i, key in enumerate(REPLAY_KEYS) if held & (1 << i)]
+        frames.append((steps, held_keys, presses))
+
+    return meta, frames
+
+
+class ScriptedKeys():
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+
+    def __getitem__(self, key):
+        return key in self.keys
+
+
+class HeadlessGame(Game):
+
+    def __init__(self):
+        self.done = False
+        self.gamepad = None
+        self.frames = 0
+        self.level_cache = LevelCache(level_cache_size)
+
+        self.reset()
+
+    def run(self, script):
+        for step in script:
+            pressed = ScriptedKeys(KEY_NAMES[k] for k in step.get('hold', []))
+            events = [pygame.event.Event(pygame.KEYDOWN, key=KEY_NAMES[k]) for k in step.get('press', [])]
+
+            for i in range(step.get('frames', 1)):
+                self.handle_input(events if i == 0 else [], pressed)
+                self.update()
+                self.frames += 1
+
+                if self.done:
+                    return
+
+    def replay(self, frames):
+        # Same order as Game.loop: input once per drawn frame, then that frame's updates
+        for steps, held_keys, presses in frames:
+            events = []
+
+            for key in presses:
+                if key == REPLAY_QUIT:
+                    events.append(pygame.event.Event(pygame.QUIT))
+                else:
+                    events.append(pygame.event.Event(pygame.KEYDOWN, key=key))
+
+            with profiler.phase('events'):
+                self.handle_input(events, ScriptedKeys(held_keys))
+
+            for i in range(steps):
+                with profiler.phase('update'):
+                    self.update()
+
+                self.frames += 1
+
+            profiler.end_frame()
+
+            if self.done:
+                return
+
+
+def print_summary(game, elapsed):
+    print("frames: {} in {:.3f}s ({:.0f} fps)".format(game.frames, elapsed, game.frames / max(elapsed, 1e-9)))
+    print("stage: {} level: {} hero: {}".format(game.stage, game.current_level, list(game.hero.rect.topleft)))
+    print("score: {} coins: {} lives: {} hearts: {}".format(game.hero.score, game.hero.coin_score, game.hero.lives, game.hero.hearts))
+
+
+def run_headless(script_path):
+    with open(script_path, 'r') as f:
+        script = json.load(f)
+
+    game = HeadlessGame()
+
+    start_time = time.perf_counter()
+    game.run(script)
+    elapsed = time.perf_counter() - start_time
+
+    print_summary(game, elapsed)
+
+
+def run_replay(replay_path):
+    global levels
+
+    meta, frames = read_replay(replay_path)
+
+    if meta['fps'] != FPS:
+        print("warning: recorded at {} fps, simulating at {}".format(meta['fps'], FPS))
+
+    levels = meta['levels']
+    game = HeadlessGame()
+
+    start_time = time.perf_counter()
+    game.replay(frames)
+    elapsed = time.perf_counter() - start_time
+
+    print_summary(game, elapsed)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=TITLE)
+    parser.add_argument("--headless", metavar="SCRIPT", help="run a JSON input script without a window")
+    parser.add_argument("--record", metavar="FILE", help="record keyboard input to FILE while playing")
+    parser.add_argument("--replay", metavar="FILE", help="replay recorded input without a window")
+    parser.add_argument("--profile", metavar="FILE", help="write frame timings to a .csv or .json file on exit")
+    args = parser.parse_args()
+
+    if args.headless:
+        run_headless(args.headless)
+        sys.exit()
+
+    if args.replay:
+        run_replay(args.replay)
+
+        if args.profile:
+            profiler.export(args.profile)
+
+        sys.exit()
+
     game = Game()
     game.start()
+
+    if args.record:
+        # Recordings only hold keyboard input
+        game.gamepad = None
+        game.recorder = InputRecorder(args.record)
+
     game.loop()
+
+    if args.profile:
+        profiler.export(args.profile)
+
     pygame.quit()
     sys.exit()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import collections
+import glob
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("HEADLESS", "1")
+
+import pygame
+import game
+
+GRID_SIZE = game.GRID_SIZE
+
+NAV_EXT = ".nav"
+NAV_VERSION = 1  # bump when Character physics change, so cached graphs get rebuilt
+
+MAX_FRAMES = 180
+
+# (direction, speed, jump): walking one tile or off a ledge, and jumps at walk and sprint speed
+MOVES = [(direction, speed, jump) for direction in [-1, 0, 1] for speed in [5, 10] for jump in [False, True]
+         if jump or (direction != 0 and speed == 5)]
+
+
+def simulate(hero, level, start, move):
+    # Plays one move from a standing spot the way Character.update would, ignoring enemies.
+    # Returns where the hero lands, or None, and whether the signExit was touched on the way.
+    direction, speed, jump = move
+    flags = [p.rect for p in level.starting_flag]
+
+    hero.rect.topleft = start
+    hero.vx = 0
+    hero.vy = 0
+    hero.speed = speed
+    hero.hearts = hero.max_hearts
+
+    if jump:
+        hero.jump(level.tilemap)
+
+    for frame in range(MAX_FRAMES):
+        if direction > 0:
+            hero.move_right()
+        elif direction < 0:
+            hero.move_left()
+        else:
+            hero.stop()
+
+        hero.apply_gravity(level)
+        hero.move_and_process_blocks(level.tilemap)
+        hero.check_world_boundaries(level)
+
+        if hero.hearts == 0:
+            return None, False
+
+        if hero.rect.collidelist(flags) != -1:
+            return hero.rect.topleft, True
+
+        if hero.on_ground:
+            if jump and frame > 0:
+                return hero.rect.topleft, False
+            if not jump and (hero.vx == 0 or abs(hero.rect.x - start[0]) >= GRID_SIZE):
+                return hero.rect.topleft, False
+
+    return None, False
+
+
+class NavGraph():
+
+    def __init__(self, nodes, edges, exits, hero_size):
+        # A node is the (col, row) of a block the hero can stand on
+        self.nodes = nodes
+        self.index = {node: i for i, node in enumerate(nodes)}
+        self.edges = edges  # per node, a list of (node index, move index)
+        self.exits = exits  # node indexes the signExit can be touched from
+        self.hero_size = hero_size
+
+    @classmethod
+    def build(cls, level):
+        hero = game.Character(game.load_alien_images())
+        w, h = hero.rect.size
+        tm = level.tilemap
+
+        def is_solid(col, row):
+            c, r = col - tm.col0, row - tm.row0
+            return 0 <= c < tm.cols and 0 <= r < tm.rows and tm.tiles[r * tm.cols + c] != 0
+
+        # Every block with room for the hero above it
+        clearance = -(-h // GRID_SIZE)
+        nodes = []
+
+        for r in range(tm.rows):
+            for c in range(tm.cols):
+                col, row = c + tm.col0, r + tm.row0
+
+                if is_solid(col, row) and not any(is_solid(col, row - k) for k in range(1, clearance + 1)):
+                    if 0 <= col * GRID_SIZE <= level.width - w:
+                        nodes.append((col, row))
+
+        graph = cls(nodes, [[] for node in nodes], set(), (w, h))
+        flags = [p.rect for p in level.starting_flag]
+
+        for i, (col, row) in enumerate(nodes):
+            spot = (col * GRID_SIZE, row * GRID_SIZE - h)
+
+            if pygame.Rect(spot, (w, h)).collidelist(flags) != -1:
+                graph.exits.add(i)
+
+            for m, move in enumerate(MOVES):
+                end, reached = simulate(hero, level, spot, move)
+
+                if reached:
+                    graph.exits.add(i)
+                elif end is not None:
+                    j = graph.node_at(end)
+
+                    if j is not None and j != i and (j, m) not in graph.edges[i]:
+                        graph.edges[i].append((j, m))
+
+        return graph
+
+    def node_at(self, spot):
+        # The block under the hero's middle, or else under either foot
+        x, y = spot
+        w, h = self.hero_size
+        row = (y + h) // GRID_SIZE
+
+        for col in [(x + w // 2) // GRID_SIZE, x // GRID_SIZE, (x + w - 1) // GRID_SIZE]:
+            if (col, row) in self.index:
+                return self.index[(col, row)]
+
+        return None
+
+    def search(self, start):
+        # Breadth-first, returns each reachable node's predecessor
+        parents = {start: None}
+        queue = collections.deque([start])
+
+        while len(queue) > 0:
+            i = queue.popleft()
+
+            for j, m in self.edges[i]:
+                if j not in parents:
+                    parents[j] = (i, m)
+                    queue.append(j)
+
+        return parents
+
+    def path_to_exit(self, start):
+        # Shortest list of (node, move) hops from start to a node the exit can be reached from, or None
+        parents = self.search(start)
+        ends = [i for i in parents if i in self.exits]
+
+        if len(ends) == 0:
+            return None
+
+        path = []
+        i = ends[0]
+
+        while parents[i] is not None:
+            i, m = parents[i]
+            path.append((self.nodes[i], MOVES[m]))
+
+        return list(reversed(path))
+
+    def to_json(self):
+        return {'nodes': self.nodes,
+                'edges': self.edges,
+                'exits': sorted(self.exits),
+                'hero-size': self.hero_size}
+
+    @classmethod
+    def from_json(cls, data):
+        nodes = [tuple(node) for node in data['nodes']]
+        edges = [[tuple(edge) for edge in node_edges] for node_edges in data['edges']]
+
+        return cls(nodes, edges, set(data['exits']), tuple(data['hero-size']))
+
+
+def nav_path(source_path):
+    return os.path.splitext(source_path)[0] + NAV_EXT
+
+
+def source_stamp(source_path):
+    stat = os.stat(source_path)
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def compile_graph(source_path):
+    graph = NavGraph.build(game.Level(source_path, game.read_level(source_path)))
+    data = graph.to_json()
+    data['version'] = NAV_VERSION
+    data['source'] = source_stamp(source_path)
+
+    with open(nav_path(source_path), 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+
+    return graph
+
+
+def load_graph(source_path, level=None):
+    # The cached graph next to the level, or built in memory when missing or stale, from level if
+    # the caller already has it. Only compile_graph writes .nav files, so this is safe in worker processes.
+    try:
+        with open(nav_path(source_path), 'r') as f:
+            data = json.load(f)
+
+        if data['version'] == NAV_VERSION and data['source'] == source_stamp(source_path):
+            return NavGraph.from_json(data)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if level is None:
+        level = game.Level(source_path, game.read_level(source_path))
+
+    return NavGraph.build(level)
+
+
+def main():
+    paths = sys.argv[1:] or sorted(glob.glob("levels/*.json"))
+
+    for path in paths:
+        start_time = time.perf_counter()
+        graph = compile_graph(path)
+        elapsed = time.perf_counter() - start_time
+
+        edges = sum(len(node_edges) for node_edges in graph.edges)
+        print("{} -> {} ({} nodes, {} edges, {:.1f}ms)".format(path, nav_path(path), len(graph.nodes), edges, elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import pygame
+
+import game
+
+ATLAS_IMAGE = "assets/atlas.png"
+ATLAS_WIDTH = 1024
+
+
+def atlas_manifest():
+    grid = game.GRID_SIZE
+    manifest = []
+
+    for item in game.ALIEN_IMAGES.values():
+        for path in (item if isinstance(item, list) else [item]):
+            manifest.append((path, grid, grid * 2))
+
+    paths = list(game.block_images.paths.values())
+
+    for images in game.ENTITY_IMAGES.values():
+        paths += images
+
+    paths += [game.HEART_EMPTY_IMG, game.SOUNDON_IMG, game.SOUNDOFF_IMG, game.HUD_PLAYER_IMG, game.HUD_X_IMG]
+    paths += [game.HUD_DIGIT_IMG.format(i) for i in range(10)]
+
+    for path in paths:
+        if (path, grid, grid) not in manifest:
+            manifest.append((path, grid, grid))
+
+    return manifest
+
+
+def pack(manifest):
+    # Shelf packing: tallest images first, left to right, a new shelf when a row is full
+    order = sorted(manifest, key=lambda item: (-item[2], item[0]))
+    rects = {}
+    x, y, shelf_height = 0, 0, 0
+
+    for path, width, height in order:
+        if x + width > ATLAS_WIDTH:
+            x, y, shelf_height = 0, y + shelf_height, 0
+
+        rects[path, width, height] = pygame.Rect(x, y, width, height)
+        x += width
+        shelf_height = max(shelf_height, height)
+
+    return rects, y + shelf_height
+
+
+def main():
+    manifest = atlas_manifest()
+    rects, height = pack(manifest)
+
+    atlas = pygame.Surface([ATLAS_WIDTH, height], pygame.SRCALPHA, 32)
+    entries = []
+
+    for (path, width, height), rect in rects.items():
+        img = pygame.transform.scale(pygame.image.load(path), (width, height))
+        atlas.blit(img, rect, special_flags=pygame.BLEND_RGBA_MAX)
+
+        stat = os.stat(path)
+        entries.append({"path": path, "width": width, "height": height, "rect": list(rect),
+                        "source": [stat.st_size, stat.st_mtime_ns]})
+
+    pygame.image.save(atlas, ATLAS_IMAGE)
+
+    with open(game.ATLAS_INDEX, 'w') as f:
+        json.dump({"image": ATLAS_IMAGE, "images": entries}, f, indent=1)
+
+    print("{} images packed into {} ({}x{}, {} bytes)".format(len(entries), ATLAS_IMAGE, ATLAS_WIDTH, atlas.get_height(),
+                                                           os.path.getsize(ATLAS_IMAGE)))
+
+
+if __name__ == "__main__":
+    main()
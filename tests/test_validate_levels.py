@@ -0,0 +1,41 @@
+import json
+import os
+
+import validate_levels
+
+EARTH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "levels", "earth.json")
+
+
+def read_earth():
+    with open(EARTH, 'r') as f:
+        return json.load(f)
+
+
+def test_earth_schema_ok():
+    assert validate_levels.check_schema(read_earth()) == []
+
+
+def test_layer_position_needs_top_or_bottom():
+    # make_layers has no start_y for any other position and the game crashes loading the level
+    for layer in ['background', 'scenery']:
+        map_data = read_earth()
+        map_data[layer + '-img'] = map_data['background-img']
+        map_data[layer + '-position'] = "middle"
+
+        assert validate_levels.check_schema(map_data) == ["'{}-position' should contain 'top' or 'bottom'".format(layer)]
+
+
+def test_layer_position_unused_without_image():
+    map_data = read_earth()
+    map_data['scenery-img'] = ""
+    map_data['scenery-position'] = "middle"
+
+    assert validate_levels.check_schema(map_data) == []
+
+
+def test_repeat_and_fill_accept_bool():
+    map_data = read_earth()
+    map_data['background-repeat-x'] = True
+    map_data['scenery-fill-y'] = False
+
+    assert validate_levels.check_schema(map_data) == []
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+os.environ.setdefault("HEADLESS", "1")
+
+import game
+import navgraph
+
+# Keys every level needs and the JSON types they may have
+SCHEMA = {"name": (str,),
+          "width": (int,),
+          "height": (int,),
+          "background-color": (list, str),
+          "background-img": (str,),
+          "background-position": (str,),
+          "background-repeat-x": (int, bool),
+          "background-fill-y": (int, bool),
+          "scenery-img": (str,),
+          "scenery-position": (str,),
+          "scenery-repeat-x": (int, bool),
+          "scenery-fill-y": (int, bool),
+          "music": (str,),
+          "start": (list,),
+          "gravity": (int, float),
+          "terminal-velocity": (int, float),
+          "blocks": (list,)}
+
+
+def check_schema(map_data):
+    errors = []
+
+    for key, types in SCHEMA.items():
+        if key not in map_data:
+            errors.append("missing '{}'".format(key))
+        elif type(map_data[key]) not in types:
+            errors.append("'{}' should be {}".format(key, " or ".join(t.__name__ for t in types)))
+
+    for key in game.LEVEL_ENTITIES:
+        if key not in map_data:
+            errors.append("missing '{}'".format(key))
+        elif not all(is_cell(item) for item in map_data[key]):
+            errors.append("'{}' should be a list of [col, row]".format(key))
+
+    if isinstance(map_data.get('start'), list) and not is_cell(map_data['start']):
+        errors.append("'start' should be [col, row]")
+
+    # Level.make_layers places layer images at the top or bottom and has no other position
+    for layer in ['background', 'scenery']:
+        img, position = map_data.get(layer + '-img'), map_data.get(layer + '-position')
+
+        if isinstance(img, str) and img != "" and isinstance(position, str):
+            if "top" not in position and "bottom" not in position:
+                errors.append("'{}-position' should contain 'top' or 'bottom'".format(layer))
+
+    if isinstance(map_data.get('blocks'), list):
+        for item in map_data['blocks']:
+            if not (isinstance(item, list) and len(item) == 3 and is_cell(item[:2]) and isinstance(item[2], str)):
+                errors.append("bad block {}".format(item))
+                break
+
+    return errors
+
+
+def is_cell(item):
+    return isinstance(item, list) and len(item) == 2 and all(isinstance(v, int) for v in item)
+
+
+def check_assets(map_data):
+    errors = []
+
+    for key in ['background-img', 'scenery-img', 'music']:
+        if map_data[key] != "" and not os.path.exists(map_data[key]):
+            errors.append("{} '{}' not found".format(key, map_data[key]))
+
+    for key in sorted({item[2] for item in map_data['blocks']}):
+        if key not in game.block_images.paths:
+            errors.append("unknown block image '{}'".format(key))
+        elif not os.path.exists(game.block_images.paths[key]):
+            errors.append("block image '{}' not found".format(game.block_images.paths[key]))
+
+    return errors
+
+
+def check_cells(map_data):
+    errors = []
+    width, height = map_data['width'], map_data['height']
+    solid = {(col, row) for col, row, key in map_data['blocks']}
+
+    if len(map_data['signExit']) == 0:
+        errors.append("no signExit")
+
+    for key in ['start'] + game.LEVEL_ENTITIES:
+        cells = [map_data['start']] if key == 'start' else map_data[key]
+
+        for col, row in cells:
+            if not (0 <= col < width and 0 <= row < height):
+                errors.append("{} at {} is outside the {}x{} level".format(key, [col, row], width, height))
+            elif key in ['start', 'signExit'] and (col, row) in solid:
+                errors.append("{} at {} is inside a block".format(key, [col, row]))
+
+    return errors
+
+
+def check_reachable(path, level):
+    # Searches the level's navigation graph from wherever the hero lands after spawning
+    graph = navgraph.load_graph(path, level)
+    hero = game.Character(game.load_alien_images())
+    spot, reached = navgraph.simulate(hero, level, (level.start_x, level.start_y), (0, 5, False))
+
+    if reached:
+        return [], len(graph.nodes)
+
+    start = None if spot is None else graph.node_at(spot)
+
+    if start is None:
+        return ["the hero can't land anywhere from the start"], len(graph.nodes)
+
+    if graph.path_to_exit(start) is None:
+        reachable = len(graph.search(start))
+        return ["signExit can't be reached from start ({} of {} nodes reachable)".format(reachable, len(graph.nodes))], len(graph.nodes)
+
+    return [], len(graph.nodes)
+
+
+def validate_level(path):
+    start_time = time.perf_counter()
+
+    try:
+        with open(path, 'r') as f:
+            map_data = json.load(f)
+    except (OSError, ValueError) as e:
+        return path, ["can't read level: {}".format(e)], "", 0
+
+    errors = check_schema(map_data)
+
+    if len(errors) == 0:
+        errors = check_assets(map_data) + check_cells(map_data)
+
+    info = ""
+
+    if len(errors) == 0:
+        reach_errors, nodes = check_reachable(path, game.Level(path, map_data))
+        errors += reach_errors
+        info = "{} nodes".format(nodes)
+
+    return path, errors, info, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check levels for schema, asset and reachability problems")
+    parser.add_argument("paths", nargs="*", help="level files (default: levels/*.json)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob("levels/*.json"))
+    failed = 0
+    start_time = time.perf_counter()
+
+    with multiprocessing.Pool(args.jobs) as pool:
+        for path, errors, info, elapsed in pool.imap(validate_level, paths):
+            if len(errors) == 0:
+                print("{}: ok ({}, {:.2f}s)".format(path, info, elapsed))
+            else:
+                failed += 1
+                print("{}: {} problem(s)".format(path, len(errors)))
+
+                for error in errors:
+                    print("    " + error)
+
+    print("{} level(s), {} failed, {:.2f}s".format(len(paths), failed, time.perf_counter() - start_time))
+
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()